@@ -10,12 +10,14 @@ from wtforms.validators import DataRequired, Email
 from werkzeug.security import generate_password_hash, check_password_hash
 import os
 from dotenv import load_dotenv
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import jwt
 from apscheduler.schedulers.background import BackgroundScheduler
 import atexit
 import logging
 from playlist_monitor import PlaylistMonitor
+from leader_lease import LeaderLease
+from db_router import REPLICA_BIND, RoutingSession, read_only_view
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
@@ -31,6 +33,9 @@ app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
     'DATABASE_URL', 'sqlite:///playlistchecker.db'
 )
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Реплика для чтения (необязательно): см. db_router.py
+if os.environ.get('DATABASE_READ_URL'):
+    app.config['SQLALCHEMY_BINDS'] = {REPLICA_BIND: os.environ['DATABASE_READ_URL']}
 
 # Конфигурация для переводов
 app.config['LANGUAGES'] = {
@@ -54,7 +59,7 @@ app.config['TEMPLATES_AUTO_RELOAD'] = True
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
 
 # Инициализация расширений
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 db.init_app(app)
 migrate = Migrate(app, db)
 login_manager = LoginManager()
@@ -157,21 +162,111 @@ class Playlist(db.Model):
     description = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_checked = db.Column(db.DateTime)
+    snapshot_id = db.Column(db.String(100))  # snapshot_id Spotify на момент последней проверки
+    
+    # Валидаторы условного GET для публичных плейлистов (Deezer, Яндекс.Музыка)
+    etag = db.Column(db.String(255))
+    last_modified = db.Column(db.String(100))
+    content_hash = db.Column(db.String(64))  # SHA-256 тела последнего ответа
+    
+    # Адаптивное расписание проверок
+    next_check_at = db.Column(db.DateTime, index=True)  # Время следующей проверки
+    change_rate = db.Column(db.Float, default=0.0)  # Затухающее среднее изменений в час
+    
+    # Счетчики треков: обновляются монитором в транзакции изменений плейлиста,
+    # чтобы страницы со списком плейлистов не загружали все треки
+    total_tracks = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    active_tracks = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    removed_tracks = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     
     # Связь с треками
     tracks = db.relationship('Track', backref='playlist', lazy=True, cascade='all, delete-orphan')
+    
+    # Индекс для поиска уже добавленного плейлиста и плейлистов пользователя
+    __table_args__ = (
+        db.Index('idx_playlist_user_service', 'user_id', 'service', 'service_playlist_id'),
+    )
 
-class Track(db.Model):
+class CatalogTrack(db.Model):
+    """Каталог треков сервиса: данные трека хранятся один раз, сколько бы
+    плейлистов его ни содержали"""
     id = db.Column(db.Integer, primary_key=True)
-    playlist_id = db.Column(db.Integer, db.ForeignKey('playlist.id'), nullable=False)
+    service = db.Column(db.String(20), nullable=False)  # spotify, deezer, apple_music, yandex_music
     service_track_id = db.Column(db.String(100), nullable=False)
     name = db.Column(db.String(200), nullable=False)
     artist = db.Column(db.String(200), nullable=False)
     album = db.Column(db.String(200))
     duration = db.Column(db.Integer)  # в секундах
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Трек однозначно определяется сервисом и своим ID в нем
+    __table_args__ = (
+        db.Index('idx_catalog_track_service', 'service', 'service_track_id', unique=True),
+    )
+
+class Track(db.Model):
+    """Трек в плейлисте: членство трека из каталога в плейлисте"""
+    id = db.Column(db.Integer, primary_key=True)
+    playlist_id = db.Column(db.Integer, db.ForeignKey('playlist.id'), nullable=False)
+    catalog_track_id = db.Column(db.Integer, db.ForeignKey('catalog_track.id'), nullable=False, index=True)
+    service_track_id = db.Column(db.String(100), nullable=False)
     added_at = db.Column(db.DateTime, default=datetime.utcnow)
     is_removed = db.Column(db.Boolean, default=False)
     removed_at = db.Column(db.DateTime)
+    
+    # Данные трека загружаются вместе с ним одним запросом
+    catalog_track = db.relationship('CatalogTrack', lazy='joined')
+    
+    # Индекс для выборки активных треков плейлиста и поиска трека в нем.
+    # Частичный уникальный индекс не дает записать трек в плейлист дважды:
+    # пакетная вставка пропускает такие строки (ON CONFLICT DO NOTHING)
+    __table_args__ = (
+        db.Index('idx_track_playlist_active', 'playlist_id', 'is_removed', 'service_track_id'),
+        db.Index('idx_track_playlist_unique_active', 'playlist_id', 'service_track_id', unique=True,
+                 postgresql_where=(is_removed == False), sqlite_where=(is_removed == False)),
+    )
+    
+    @property
+    def name(self):
+        return self.catalog_track.name
+    
+    @property
+    def artist(self):
+        return self.catalog_track.artist
+    
+    @property
+    def album(self):
+        return self.catalog_track.album
+    
+    @property
+    def duration(self):
+        return self.catalog_track.duration
+
+class PlaylistVersion(db.Model):
+    """Версия состава плейлиста.
+    
+    Контрольная точка (is_checkpoint) хранит полный список ID треков в
+    added_ids, остальные версии - только изменения относительно предыдущей
+    версии (добавленные и удаленные ID). Состав на любой момент собирается
+    из ближайшей контрольной точки и следующих за ней изменений.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    playlist_id = db.Column(db.Integer, db.ForeignKey('playlist.id'), nullable=False)
+    version = db.Column(db.Integer, nullable=False)  # Порядковый номер версии плейлиста
+    checkpoint_version = db.Column(db.Integer, nullable=False)  # Номер контрольной точки, от которой считаются изменения
+    is_checkpoint = db.Column(db.Boolean, nullable=False, default=False)
+    added_ids = db.Column(db.Text, nullable=False, default='[]')  # JSON-список ID треков в сервисе
+    removed_ids = db.Column(db.Text, nullable=False, default='[]')
+    track_count = db.Column(db.Integer, nullable=False, default=0)  # Треков в плейлисте после этой версии
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    # Номер версии уникален в плейлисте: одновременная запись той же версии
+    # двумя проверками откатит одну из них. Второй индекс - для поиска
+    # версий плейлиста на момент времени
+    __table_args__ = (
+        db.Index('idx_playlist_version_number', 'playlist_id', 'version', unique=True),
+        db.Index('idx_playlist_version_created', 'playlist_id', 'created_at'),
+    )
 
 class Notification(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -185,6 +280,11 @@ class Notification(db.Model):
     # Связи
     playlist = db.relationship('Playlist', backref='notifications', lazy=True)
     track = db.relationship('Track', backref='notifications', lazy=True)
+    
+    # Индекс для последних непрочитанных уведомлений пользователя
+    __table_args__ = (
+        db.Index('idx_notification_user_unread', 'user_id', 'is_read', 'created_at'),
+    )
 
 class PushSubscription(db.Model):
     """Модель для хранения push-подписок браузерных уведомлений"""
@@ -215,9 +315,61 @@ class NotificationHistory(db.Model):
     user = db.relationship('User', backref='notification_history', lazy=True)
     playlist = db.relationship('Playlist', backref='notification_history', lazy=True)
     
-    # Индекс для быстрого поиска уникальных уведомлений
+    # Индекс для быстрого поиска уникальных уведомлений и индекс для
+    # постраничной истории уведомлений пользователя
     __table_args__ = (
         db.Index('idx_unique_notification', 'user_id', 'playlist_id', 'track_service_id', 'notification_type'),
+        db.Index('idx_notification_history_user_sent', 'user_id', 'sent_at'),
+    )
+
+class NotificationOutbox(db.Model):
+    """Очередь уведомлений: монитор пишет сюда в транзакции изменений плейлиста,
+    а отдельный диспетчер отправляет их по каналам с повторными попытками"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    playlist_id = db.Column(db.Integer, db.ForeignKey('playlist.id'), nullable=False)
+    payload = db.Column(db.Text, nullable=False)  # JSON с данными уведомления
+    status = db.Column(db.String(20), nullable=False, default='pending')  # 'pending', 'sent', 'skipped', 'failed'
+    channel_status = db.Column(db.Text)  # JSON: статус отправки по каждому каналу
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_error = db.Column(db.Text)
+    history_id = db.Column(db.Integer, db.ForeignKey('notification_history.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+    
+    # Индекс для выборки уведомлений, готовых к отправке
+    __table_args__ = (
+        db.Index('idx_outbox_due', 'status', 'next_attempt_at'),
+    )
+
+class SchedulerLease(db.Model):
+    """Аренда роли ведущего планировщика среди воркеров и хостов"""
+    name = db.Column(db.String(50), primary_key=True)
+    holder = db.Column(db.String(255), nullable=False)  # hostname:pid процесса
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+class CheckTask(db.Model):
+    """Задача проверки группы плейлистов для распределенных воркеров.
+    
+    Воркер забирает задачу в аренду (lease_owner, lease_expires_at); если он
+    упал, не завершив проверку, по истечении аренды задачу забирает другой.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    group_key = db.Column(db.String(255), nullable=False, index=True)  # сервис:ID плейлиста[:пользователь]
+    service = db.Column(db.String(50), nullable=False)
+    playlist_ids = db.Column(db.Text, nullable=False)  # JSON-список ID плейлистов группы
+    status = db.Column(db.String(20), nullable=False, default='pending')  # 'pending', 'running', 'done', 'failed'
+    lease_owner = db.Column(db.String(255))
+    lease_expires_at = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    
+    # Индекс для выборки задач, которые можно забрать
+    __table_args__ = (
+        db.Index('idx_check_task_claimable', 'status', 'lease_expires_at'),
     )
 
 # Формы
@@ -270,6 +422,7 @@ def load_user(user_id):
 
 # Главная страница
 @app.route('/')
+@read_only_view
 def index():
     if current_user.is_authenticated:
         playlists = Playlist.query.filter_by(user_id=current_user.id).all()
@@ -499,6 +652,7 @@ def set_language(language=None):
 # Управление плейлистами
 @app.route('/playlists')
 @login_required
+@read_only_view
 def playlists():
     playlists = Playlist.query.filter_by(user_id=current_user.id).all()
     return render_template('playlists.html', playlists=playlists)
@@ -622,6 +776,7 @@ def check_playlists_now():
 
 @app.route('/playlist/<int:playlist_id>/tracks')
 @login_required
+@read_only_view
 def playlist_tracks(playlist_id):
     """Показать треки плейлиста"""
     playlist = Playlist.query.filter_by(id=playlist_id, user_id=current_user.id).first()
@@ -632,6 +787,41 @@ def playlist_tracks(playlist_id):
     tracks = Track.query.filter_by(playlist_id=playlist_id).order_by(Track.added_at.desc()).all()
     return render_template('playlist_tracks.html', playlist=playlist, tracks=tracks)
 
+@app.route('/api/playlist/<int:playlist_id>/membership')
+@login_required
+@read_only_view
+def playlist_membership(playlist_id):
+    """Состав плейлиста на момент времени из истории версий.
+    
+    Момент передается параметром at в формате ISO 8601 (без часового пояса
+    считается UTC), по умолчанию - текущий.
+    """
+    playlist = Playlist.query.filter_by(id=playlist_id, user_id=current_user.id).first()
+    if not playlist:
+        return {'error': 'Плейлист не найден'}, 404
+    
+    at = None
+    if request.args.get('at'):
+        try:
+            at = datetime.fromisoformat(request.args['at'])
+        except ValueError:
+            return {'error': 'Некорректный формат времени, ожидается ISO 8601'}, 400
+        if at.tzinfo is not None:
+            at = at.astimezone(timezone.utc).replace(tzinfo=None)
+    
+    membership = monitor.get_playlist_membership(playlist, at)
+    if membership is None:
+        return {'error': 'Нет истории плейлиста на этот момент'}, 404
+    
+    return {
+        'playlist_id': playlist.id,
+        'at': (at or datetime.utcnow()).isoformat(),
+        'version': membership['version'],
+        'version_created_at': membership['created_at'].isoformat(),
+        'track_count': len(membership['tracks']),
+        'tracks': membership['tracks']
+    }
+
 # API для авторизации в сервисах
 @app.route('/auth/spotify')
 @login_required
@@ -673,6 +863,7 @@ def spotify_callback():
         )
         db.session.add(spotify_token)
         db.session.commit()
+        monitor.spotify_tokens.invalidate(current_user.id)
         
         flash(gettext('flash.spotify_connected_success'))
         return redirect(url_for('index'))
@@ -727,6 +918,7 @@ def notification_settings():
 
 @app.route('/notification_history')
 @login_required
+@read_only_view
 def notification_history():
     """История уведомлений пользователя"""
     page = request.args.get('page', 1, type=int)
@@ -871,34 +1063,125 @@ def get_vapid_public_key():
 # Создаем глобальный экземпляр монитора
 monitor = PlaylistMonitor(app)
 
+# Аренда роли ведущего: задачи по расписанию выполняет только один процесс
+# среди всех воркеров gunicorn и хостов
+scheduler_lease = LeaderLease(
+    'scheduler',
+    ttl_seconds=int(os.environ.get('SCHEDULER_LEASE_TTL', 90))
+)
+
+def renew_scheduler_lease():
+    """Получить или продлить аренду ведущего планировщика"""
+    with app.app_context():
+        scheduler_lease.acquire()
+
 # Планировщик задач
 def check_playlists():
-    """Функция для проверки всех плейлистов на изменения"""
+    """Функция для проверки плейлистов, у которых наступило время проверки"""
     from datetime import datetime
+    if not scheduler_lease.is_held():
+        return
     print(f"[{datetime.now()}] Запуск проверки плейлистов...")
     try:
         # Используем глобальную переменную app с контекстом
         with app.app_context():
-            monitor.check_all_playlists()
+            if os.environ.get('CHECK_MODE', 'local') == 'distributed':
+                # Проверяют воркеры check_worker.py, здесь только ставим задачи
+                monitor.enqueue_due_checks()
+            else:
+                monitor.check_due_playlists()
         print(f"[{datetime.now()}] Проверка плейлистов завершена успешно")
     except Exception as e:
         print(f"[{datetime.now()}] Ошибка при проверке плейлистов: {str(e)}")
         import traceback
         traceback.print_exc()
 
+def dispatch_notifications():
+    """Функция для отправки уведомлений из очереди"""
+    if not scheduler_lease.is_held():
+        return
+    try:
+        with app.app_context():
+            from services.notification_service import notification_service
+            notification_service.dispatch_outbox()
+    except Exception as e:
+        logger.error(f"Ошибка при отправке уведомлений из очереди: {str(e)}")
+
+def refresh_spotify_tokens():
+    """Функция для упреждающего обновления истекающих токенов Spotify"""
+    if not scheduler_lease.is_held():
+        return
+    try:
+        monitor.refresh_spotify_tokens()
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении токенов Spotify: {str(e)}")
+
+def archive_old_data():
+    """Функция для переноса устаревших данных в архив"""
+    if not scheduler_lease.is_held():
+        return
+    try:
+        with app.app_context():
+            from services.retention_service import retention_service
+            retention_service.archive()
+    except Exception as e:
+        logger.error(f"Ошибка при архивации устаревших данных: {str(e)}")
+
+def shutdown_scheduler():
+    """Остановить планировщик и освободить аренду ведущего"""
+    scheduler.shutdown()
+    with app.app_context():
+        scheduler_lease.release()
+
 # Настройка планировщика
 scheduler = BackgroundScheduler()
+scheduler.add_job(
+    func=renew_scheduler_lease,
+    trigger="interval",
+    # Продлеваем аренду заметно чаще, чем она истекает
+    seconds=max(5, int(os.environ.get('SCHEDULER_LEASE_TTL', 90)) // 3),
+    id='scheduler_lease',
+    next_run_time=datetime.now()
+)
 scheduler.add_job(
     func=check_playlists,
-    trigger="cron",
-    hour=9,  # Проверяем каждый день в 9:00 утра
-    minute=0,
+    trigger="interval",
+    # Каждый плейлист проверяется по своему расписанию (next_check_at),
+    # планировщик лишь регулярно забирает те, чей срок наступил
+    minutes=int(os.environ.get('CHECK_POLL_INTERVAL_MINUTES', 5)),
     id='playlist_checker'
 )
-scheduler.start()
+scheduler.add_job(
+    func=dispatch_notifications,
+    trigger="interval",
+    seconds=int(os.environ.get('NOTIFICATION_DISPATCH_INTERVAL', 60)),
+    id='notification_dispatcher'
+)
+scheduler.add_job(
+    func=refresh_spotify_tokens,
+    trigger="interval",
+    # Интервал должен быть меньше SPOTIFY_TOKEN_LOOKAHEAD, чтобы токен
+    # обновлялся раньше, чем истечет
+    minutes=int(os.environ.get('SPOTIFY_TOKEN_REFRESH_INTERVAL_MINUTES', 10)),
+    id='spotify_token_refresh'
+)
+# Архивация выключена по умолчанию: каталог ARCHIVE_DIR должен лежать
+# на постоянном томе, иначе архив пропадет вместе с контейнером
+if os.environ.get('RETENTION_ENABLED', 'false').lower() == 'true':
+    scheduler.add_job(
+        func=archive_old_data,
+        trigger="interval",
+        hours=int(os.environ.get('RETENTION_INTERVAL_HOURS', 24)),
+        id='retention_archiver'
+    )
 
-# Остановка планировщика при выходе
-atexit.register(lambda: scheduler.shutdown())
+# SCHEDULER_ENABLED=false отключает планировщик в этом процессе, например
+# в веб-воркерах, если задачи выполняет отдельный процесс
+if os.environ.get('SCHEDULER_ENABLED', 'true').lower() == 'true':
+    scheduler.start()
+    
+    # Остановка планировщика при выходе
+    atexit.register(shutdown_scheduler)
 
 if __name__ == '__main__':
     with app.app_context():
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Архивация старых данных и восстановление их из архива.
+
+    python archive_data.py archive                  # перенести в архив устаревшие строки
+    python archive_data.py restore FILE [FILE ...]  # вернуть строки из файлов архива
+
+Сроки хранения и каталог архива задаются переменными окружения
+RETENTION_* и ARCHIVE_DIR (см. env_example.txt).
+"""
+
+import argparse
+import os
+
+# Скрипту не нужен планировщик веб-приложения
+os.environ.setdefault('SCHEDULER_ENABLED', 'false')
+
+from app import app
+from services.retention_service import retention_service
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Архивация старых данных PlaylistChecker')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('archive', help='перенести в архив строки старше сроков хранения')
+    restore_parser = subparsers.add_parser('restore', help='вернуть в базу строки из файлов архива')
+    restore_parser.add_argument('files', nargs='+', help='файлы архива (*.jsonl.gz)')
+    args = parser.parse_args()
+    
+    with app.app_context():
+        if args.command == 'archive':
+            path, counts = retention_service.archive()
+            if path is None:
+                print("Устаревших данных нет")
+            else:
+                print(f"Архив записан в {path}")
+                for table, count in counts.items():
+                    print(f"  {table}: {count}")
+        else:
+            for path in args.files:
+                counts = retention_service.restore(path)
+                print(f"Восстановлено из {path}:")
+                for table, count in counts.items():
+                    print(f"  {table}: {count}")
+                if not counts:
+                    print("  новых строк нет")
+
+
+if __name__ == '__main__':
+    main()
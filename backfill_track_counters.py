@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Скрипт для пересчета счетчиков треков плейлистов (total_tracks, active_tracks,
+removed_tracks) по таблице треков.
+
+Монитор поддерживает счетчики сам; скрипт нужен, если треки менялись в базе
+вручную. Обновляются только плейлисты, у которых счетчики разошлись с треками.
+"""
+
+import os
+import sys
+
+from sqlalchemy import func, or_, select, update
+
+# Добавляем текущую директорию в путь Python
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Импортируем после добавления пути
+from app import app, db, Playlist, Track
+
+
+def backfill_track_counters():
+    """Пересчитать счетчики треков всех плейлистов одним запросом"""
+    with app.app_context():
+        def count_tracks(*conditions):
+            return select(func.count(Track.id)).where(
+                Track.playlist_id == Playlist.id, *conditions
+            ).scalar_subquery()
+
+        total = count_tracks()
+        active = count_tracks(Track.is_removed == False)
+        removed = count_tracks(Track.is_removed == True)
+
+        result = db.session.execute(
+            update(Playlist).where(or_(
+                Playlist.total_tracks != total,
+                Playlist.active_tracks != active,
+                Playlist.removed_tracks != removed
+            )).values(total_tracks=total, active_tracks=active, removed_tracks=removed),
+            execution_options={'synchronize_session': False}
+        )
+        db.session.commit()
+
+        print(f"Счетчики треков пересчитаны. Исправлено плейлистов: {result.rowcount}")
+        return result.rowcount
+
+if __name__ == '__main__':
+    backfill_track_counters()
@@ -12,10 +12,12 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 # Импортируем после добавления пути
 from app import app, db, User, Playlist, Track, Notification, SpotifyToken, DeezerToken, AppleMusicToken, YandexMusicToken
+from db_router import replica_reads
 
 def show_database_stats():
     """Показать статистику базы данных"""
-    with app.app_context():
+    # Статистика только читает данные, поэтому читаем с реплики (если задана)
+    with app.app_context(), replica_reads():
         print("=" * 50)
         print("СТАТИСТИКА БАЗЫ ДАННЫХ PLAYLISTCHECKER")
         print("=" * 50)
@@ -112,7 +114,7 @@ def show_database_stats():
 
 def show_user_details(user_id=None):
     """Показать детальную информацию о пользователе"""
-    with app.app_context():
+    with app.app_context(), replica_reads():
         if user_id:
             user = User.query.get(user_id)
             if not user:
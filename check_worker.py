@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+"""
+Воркер распределенной проверки плейлистов.
+
+Забирает задачи из таблицы check_task (их ставит в очередь планировщик при
+CHECK_MODE=distributed) и проверяет плейлисты. Воркеров можно запускать
+на любом количестве хостов с общей базой данных.
+"""
+
+import argparse
+import os
+
+# Воркеру не нужен планировщик веб-приложения
+os.environ.setdefault('SCHEDULER_ENABLED', 'false')
+
+from app import monitor
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Воркер проверки плейлистов PlaylistChecker')
+    parser.add_argument('--once', action='store_true',
+                        help='выполнить задачи из очереди и завершиться')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='количество потоков (по умолчанию CHECK_MAX_WORKERS)')
+    args = parser.parse_args()
+    
+    try:
+        monitor.run_worker(once=args.once, threads=args.threads)
+    except KeyboardInterrupt:
+        print("Воркер остановлен")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Маршрутизация запросов к базе данных между основной базой и репликой.
+
+Если задан DATABASE_READ_URL, запросы на чтение внутри replica_reads() (и в
+представлениях с декоратором read_only_view) выполняются на реплике, чтобы
+тяжелые записи проверки плейлистов не замедляли страницы сайта. Запись
+(INSERT/UPDATE/DELETE и сохранение объектов сессии) всегда идет в основную
+базу. Реплика отстает от основной базы, поэтому после записи в запросе
+пользователя его страницы еще REPLICA_READ_AFTER_WRITE_SECONDS секунд
+читаются из основной базы: пользователь сразу видит свои изменения.
+"""
+
+import contextvars
+import functools
+import os
+import time
+from contextlib import contextmanager
+
+from flask import has_request_context, session as flask_session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.sql.dml import UpdateBase
+
+# Ключ реплики в SQLALCHEMY_BINDS
+REPLICA_BIND = 'replica'
+
+# Ключ в сессии Flask со временем последней записи пользователя
+LAST_WRITE_KEY = '_db_last_write'
+
+_use_replica = contextvars.ContextVar('use_replica', default=False)
+
+
+class RoutingSession(Session):
+    """Сессия, отправляющая чтение на реплику внутри replica_reads()"""
+    
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and _use_replica.get() and not self._flushing and not isinstance(clause, UpdateBase):
+            replica = self._db.engines.get(REPLICA_BIND)
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _remember_write(db_session):
+    """Запомнить время записи в запросе пользователя"""
+    if has_request_context():
+        flask_session[LAST_WRITE_KEY] = time.time()
+
+
+@contextmanager
+def replica_reads():
+    """Выполнять чтение внутри блока на реплике (если она настроена)"""
+    token = _use_replica.set(True)
+    try:
+        yield
+    finally:
+        _use_replica.reset(token)
+
+
+def _recent_write():
+    """Была ли у пользователя запись недавно, чтобы реплика могла ее еще не получить"""
+    last_write = flask_session.get(LAST_WRITE_KEY)
+    window = float(os.environ.get('REPLICA_READ_AFTER_WRITE_SECONDS', 10))
+    return last_write is not None and time.time() - last_write < window
+
+
+def read_only_view(view):
+    """Декоратор представления, которое только читает данные: запросы идут на
+    реплику, если пользователь недавно ничего не записывал"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if _recent_write():
+            return view(*args, **kwargs)
+        with replica_reads():
+            return view(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,95 @@
+"""
+Выбор ведущего процесса через аренду строки в базе данных.
+
+Gunicorn запускает несколько воркеров, и в каждом работает свой планировщик.
+Задачи по расписанию должен выполнять только один из них: тот, кто удерживает
+аренду. Аренда продлевается регулярно; если ведущий процесс завис или упал,
+по истечении срока аренды ее забирает другой процесс.
+"""
+
+import logging
+import os
+import socket
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderLease:
+    """Аренда роли ведущего процесса, хранящаяся в таблице scheduler_lease"""
+    
+    def __init__(self, name, ttl_seconds=90, holder=None):
+        self.name = name
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.holder = holder or f"{socket.gethostname()}:{os.getpid()}"
+        self._expires_at = None
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        """Получить или продлить аренду. Возвращает True, если процесс ведущий.
+        
+        Аренда забирается условным UPDATE (свободна, истекла или уже наша),
+        поэтому даже при одновременной попытке нескольких процессов ее получит
+        только один.
+        """
+        from app import db, SchedulerLease
+        
+        with self._lock:
+            now = datetime.utcnow()
+            expires_at = now + self.ttl
+            try:
+                updated = db.session.query(SchedulerLease).filter(
+                    SchedulerLease.name == self.name,
+                    or_(SchedulerLease.holder == self.holder, SchedulerLease.expires_at < now)
+                ).update({'holder': self.holder, 'expires_at': expires_at}, synchronize_session=False)
+                
+                if not updated and db.session.get(SchedulerLease, self.name) is None:
+                    db.session.add(SchedulerLease(name=self.name, holder=self.holder, expires_at=expires_at))
+                    db.session.flush()
+                    updated = 1
+                
+                db.session.commit()
+            except IntegrityError:
+                # Строку аренды одновременно создал другой процесс
+                db.session.rollback()
+                updated = 0
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Ошибка при получении аренды {self.name}: {str(e)}")
+                updated = 0
+            
+            was_leader = self._expires_at is not None and self._expires_at > now
+            self._expires_at = expires_at if updated else None
+            
+            if updated and not was_leader:
+                logger.info(f"Процесс {self.holder} стал ведущим ({self.name})")
+            elif was_leader and not updated:
+                logger.warning(f"Процесс {self.holder} потерял аренду {self.name}")
+            
+            return bool(updated)
+    
+    def is_held(self):
+        """Удерживает ли процесс аренду прямо сейчас (без запроса к БД)"""
+        expires_at = self._expires_at
+        return expires_at is not None and datetime.utcnow() < expires_at
+    
+    def release(self):
+        """Освободить аренду, чтобы другой процесс мог сразу ее забрать"""
+        from app import db, SchedulerLease
+        
+        with self._lock:
+            if self._expires_at is None:
+                return
+            self._expires_at = None
+            try:
+                db.session.query(SchedulerLease).filter_by(
+                    name=self.name, holder=self.holder
+                ).update({'expires_at': datetime.utcnow()}, synchronize_session=False)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Ошибка при освобождении аренды {self.name}: {str(e)}")
@@ -0,0 +1,26 @@
+"""Add snapshot_id to Playlist to skip unchanged Spotify playlists
+
+Revision ID: 3f9a2c71d4e8
+Revises: ad0c584cc8c9
+Create Date: 2026-10-17 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9a2c71d4e8'
+down_revision = 'ad0c584cc8c9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('playlist', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('snapshot_id', sa.String(length=100), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('playlist', schema=None) as batch_op:
+        batch_op.drop_column('snapshot_id')
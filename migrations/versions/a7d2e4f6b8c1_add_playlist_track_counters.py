@@ -0,0 +1,41 @@
+"""Add denormalized track counters to Playlist
+
+Revision ID: a7d2e4f6b8c1
+Revises: f6c9d3e5a7b2
+Create Date: 2026-10-17 17:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7d2e4f6b8c1'
+down_revision = 'f6c9d3e5a7b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('playlist', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('total_tracks', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('active_tracks', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('removed_tracks', sa.Integer(), nullable=False, server_default='0'))
+
+    # Заполняем счетчики по уже сохраненным трекам (то же делает
+    # backfill_track_counters.py, если счетчики нужно пересчитать позже)
+    op.execute(
+        "UPDATE playlist SET "
+        "total_tracks = (SELECT COUNT(*) FROM track WHERE track.playlist_id = playlist.id), "
+        "active_tracks = (SELECT COUNT(*) FROM track WHERE track.playlist_id = playlist.id "
+        "AND track.is_removed = false), "
+        "removed_tracks = (SELECT COUNT(*) FROM track WHERE track.playlist_id = playlist.id "
+        "AND track.is_removed = true)"
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('playlist', schema=None) as batch_op:
+        batch_op.drop_column('removed_tracks')
+        batch_op.drop_column('active_tracks')
+        batch_op.drop_column('total_tracks')
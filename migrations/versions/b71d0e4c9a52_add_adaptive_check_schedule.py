@@ -0,0 +1,30 @@
+"""Add adaptive check schedule fields to Playlist
+
+Revision ID: b71d0e4c9a52
+Revises: 9c4e5b2a7f13
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b71d0e4c9a52'
+down_revision = '9c4e5b2a7f13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('playlist', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('next_check_at', sa.DateTime(), nullable=True))
+        batch_op.add_column(sa.Column('change_rate', sa.Float(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_playlist_next_check_at'), ['next_check_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('playlist', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_playlist_next_check_at'))
+        batch_op.drop_column('change_rate')
+        batch_op.drop_column('next_check_at')
@@ -0,0 +1,86 @@
+"""Move track metadata to a shared catalog_track table
+
+Revision ID: b8e3f5a7c9d2
+Revises: a7d2e4f6b8c1
+Create Date: 2026-10-17 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8e3f5a7c9d2'
+down_revision = 'a7d2e4f6b8c1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('catalog_track',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('service', sa.String(length=20), nullable=False),
+        sa.Column('service_track_id', sa.String(length=100), nullable=False),
+        sa.Column('name', sa.String(length=200), nullable=False),
+        sa.Column('artist', sa.String(length=200), nullable=False),
+        sa.Column('album', sa.String(length=200), nullable=True),
+        sa.Column('duration', sa.Integer(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('catalog_track', schema=None) as batch_op:
+        batch_op.create_index('idx_catalog_track_service', ['service', 'service_track_id'], unique=True)
+
+    with op.batch_alter_table('track', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('catalog_track_id', sa.Integer(), nullable=True))
+
+    # Переносим данные треков в каталог: по одной записи на трек сервиса
+    op.execute(
+        "INSERT INTO catalog_track (service, service_track_id, name, artist, album, duration, created_at) "
+        "SELECT playlist.service, track.service_track_id, MIN(track.name), MIN(track.artist), "
+        "MIN(track.album), MIN(track.duration), MIN(track.added_at) "
+        "FROM track JOIN playlist ON playlist.id = track.playlist_id "
+        "GROUP BY playlist.service, track.service_track_id"
+    )
+    op.execute(
+        "UPDATE track SET catalog_track_id = ("
+        "SELECT catalog_track.id FROM catalog_track, playlist "
+        "WHERE playlist.id = track.playlist_id AND catalog_track.service = playlist.service "
+        "AND catalog_track.service_track_id = track.service_track_id)"
+    )
+
+    with op.batch_alter_table('track', schema=None) as batch_op:
+        batch_op.alter_column('catalog_track_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.create_index(batch_op.f('ix_track_catalog_track_id'), ['catalog_track_id'], unique=False)
+        batch_op.create_foreign_key('fk_track_catalog_track_id', 'catalog_track', ['catalog_track_id'], ['id'])
+        batch_op.drop_column('duration')
+        batch_op.drop_column('album')
+        batch_op.drop_column('artist')
+        batch_op.drop_column('name')
+
+
+def downgrade():
+    with op.batch_alter_table('track', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('name', sa.String(length=200), nullable=True))
+        batch_op.add_column(sa.Column('artist', sa.String(length=200), nullable=True))
+        batch_op.add_column(sa.Column('album', sa.String(length=200), nullable=True))
+        batch_op.add_column(sa.Column('duration', sa.Integer(), nullable=True))
+
+    # Возвращаем данные треков из каталога в каждую строку
+    for column in ('name', 'artist', 'album', 'duration'):
+        op.execute(
+            f"UPDATE track SET {column} = (SELECT catalog_track.{column} FROM catalog_track "
+            f"WHERE catalog_track.id = track.catalog_track_id)"
+        )
+
+    with op.batch_alter_table('track', schema=None) as batch_op:
+        batch_op.alter_column('name', existing_type=sa.String(length=200), nullable=False)
+        batch_op.alter_column('artist', existing_type=sa.String(length=200), nullable=False)
+        batch_op.drop_constraint('fk_track_catalog_track_id', type_='foreignkey')
+        batch_op.drop_index(batch_op.f('ix_track_catalog_track_id'))
+        batch_op.drop_column('catalog_track_id')
+
+    with op.batch_alter_table('catalog_track', schema=None) as batch_op:
+        batch_op.drop_index('idx_catalog_track_service')
+
+    op.drop_table('catalog_track')
@@ -0,0 +1,29 @@
+"""Add scheduler lease table for single-leader scheduling
+
+Revision ID: c2a8f6e1b3d7
+Revises: b71d0e4c9a52
+Create Date: 2026-10-17 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2a8f6e1b3d7'
+down_revision = 'b71d0e4c9a52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('scheduler_lease',
+    sa.Column('name', sa.String(length=50), nullable=False),
+    sa.Column('holder', sa.String(length=255), nullable=False),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('scheduler_lease')
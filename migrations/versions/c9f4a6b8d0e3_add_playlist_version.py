@@ -0,0 +1,68 @@
+"""Add delta-encoded playlist version history
+
+Revision ID: c9f4a6b8d0e3
+Revises: b8e3f5a7c9d2
+Create Date: 2026-10-17 19:00:00.000000
+
+"""
+from datetime import datetime
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c9f4a6b8d0e3'
+down_revision = 'b8e3f5a7c9d2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    playlist_version = op.create_table('playlist_version',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('playlist_id', sa.Integer(), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.Column('checkpoint_version', sa.Integer(), nullable=False),
+        sa.Column('is_checkpoint', sa.Boolean(), nullable=False),
+        sa.Column('added_ids', sa.Text(), nullable=False),
+        sa.Column('removed_ids', sa.Text(), nullable=False),
+        sa.Column('track_count', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['playlist_id'], ['playlist.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('playlist_version', schema=None) as batch_op:
+        batch_op.create_index('idx_playlist_version_number', ['playlist_id', 'version'], unique=True)
+        batch_op.create_index('idx_playlist_version_created', ['playlist_id', 'created_at'], unique=False)
+
+    # История начинается с контрольной точки текущего состава каждого плейлиста
+    connection = op.get_bind()
+    now = datetime.utcnow()
+    track_ids = {}
+    for playlist_id, service_track_id in connection.execute(sa.text(
+        "SELECT playlist_id, service_track_id FROM track WHERE is_removed = false ORDER BY playlist_id, id"
+    )):
+        track_ids.setdefault(playlist_id, {})[service_track_id] = None
+
+    rows = [{
+        'playlist_id': playlist_id,
+        'version': 1,
+        'checkpoint_version': 1,
+        'is_checkpoint': True,
+        'added_ids': json.dumps(list(ids)),
+        'removed_ids': '[]',
+        'track_count': len(ids),
+        'created_at': now
+    } for playlist_id, ids in track_ids.items()]
+    if rows:
+        op.bulk_insert(playlist_version, rows)
+
+
+def downgrade():
+    with op.batch_alter_table('playlist_version', schema=None) as batch_op:
+        batch_op.drop_index('idx_playlist_version_created')
+        batch_op.drop_index('idx_playlist_version_number')
+
+    op.drop_table('playlist_version')
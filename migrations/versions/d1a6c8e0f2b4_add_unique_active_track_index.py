@@ -0,0 +1,52 @@
+"""Add partial unique index on active playlist tracks
+
+Revision ID: d1a6c8e0f2b4
+Revises: c9f4a6b8d0e3
+Create Date: 2026-10-17 20:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd1a6c8e0f2b4'
+down_revision = 'c9f4a6b8d0e3'
+branch_labels = None
+depends_on = None
+
+# Повторы одного трека среди активных треков плейлиста: все, кроме первой записи
+DUPLICATE_TRACKS = (
+    "SELECT id FROM track WHERE is_removed = false AND id NOT IN ("
+    "SELECT MIN(id) FROM track WHERE is_removed = false GROUP BY playlist_id, service_track_id)"
+)
+
+
+def upgrade():
+    # Раньше при добавлении плейлиста повторы трека в ответе сервиса
+    # записывались отдельными строками. Уведомления о повторах переводим на
+    # первую запись трека, а сами повторы удаляем
+    op.execute(
+        "UPDATE notification SET track_id = ("
+        "SELECT MIN(first.id) FROM track first, track duplicate "
+        "WHERE duplicate.id = notification.track_id AND first.playlist_id = duplicate.playlist_id "
+        "AND first.service_track_id = duplicate.service_track_id AND first.is_removed = false"
+        f") WHERE track_id IN ({DUPLICATE_TRACKS})"
+    )
+    op.execute(f"DELETE FROM track WHERE id IN ({DUPLICATE_TRACKS})")
+    op.execute(
+        "UPDATE playlist SET "
+        "total_tracks = (SELECT COUNT(*) FROM track WHERE track.playlist_id = playlist.id), "
+        "active_tracks = (SELECT COUNT(*) FROM track WHERE track.playlist_id = playlist.id "
+        "AND track.is_removed = false)"
+    )
+
+    with op.batch_alter_table('track', schema=None) as batch_op:
+        batch_op.create_index('idx_track_playlist_unique_active', ['playlist_id', 'service_track_id'], unique=True,
+                              postgresql_where=sa.text('is_removed = false'),
+                              sqlite_where=sa.text('is_removed = 0'))
+
+
+def downgrade():
+    with op.batch_alter_table('track', schema=None) as batch_op:
+        batch_op.drop_index('idx_track_playlist_unique_active')
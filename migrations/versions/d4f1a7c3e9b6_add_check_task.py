@@ -0,0 +1,44 @@
+"""Add check task table for distributed playlist checks
+
+Revision ID: d4f1a7c3e9b6
+Revises: c2a8f6e1b3d7
+Create Date: 2026-10-17 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4f1a7c3e9b6'
+down_revision = 'c2a8f6e1b3d7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('check_task',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('group_key', sa.String(length=255), nullable=False),
+    sa.Column('service', sa.String(length=50), nullable=False),
+    sa.Column('playlist_ids', sa.Text(), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('lease_owner', sa.String(length=255), nullable=True),
+    sa.Column('lease_expires_at', sa.DateTime(), nullable=True),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('check_task', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_check_task_group_key'), ['group_key'], unique=False)
+        batch_op.create_index('idx_check_task_claimable', ['status', 'lease_expires_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('check_task', schema=None) as batch_op:
+        batch_op.drop_index('idx_check_task_claimable')
+        batch_op.drop_index(batch_op.f('ix_check_task_group_key'))
+
+    op.drop_table('check_task')
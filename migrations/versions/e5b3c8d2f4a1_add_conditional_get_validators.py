@@ -0,0 +1,30 @@
+"""Add conditional GET validators to Playlist
+
+Revision ID: e5b3c8d2f4a1
+Revises: d4f1a7c3e9b6
+Create Date: 2026-10-17 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b3c8d2f4a1'
+down_revision = 'd4f1a7c3e9b6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('playlist', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('etag', sa.String(length=255), nullable=True))
+        batch_op.add_column(sa.Column('last_modified', sa.String(length=100), nullable=True))
+        batch_op.add_column(sa.Column('content_hash', sa.String(length=64), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('playlist', schema=None) as batch_op:
+        batch_op.drop_column('content_hash')
+        batch_op.drop_column('last_modified')
+        batch_op.drop_column('etag')
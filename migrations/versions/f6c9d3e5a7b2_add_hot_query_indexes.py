@@ -0,0 +1,53 @@
+"""Add composite indexes for hot queries
+
+Revision ID: f6c9d3e5a7b2
+Revises: e5b3c8d2f4a1
+Create Date: 2026-10-17 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f6c9d3e5a7b2'
+down_revision = 'e5b3c8d2f4a1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Активные треки плейлиста (playlist_id, is_removed) и поиск трека
+    # в плейлисте (playlist_id, service_track_id, is_removed) - один индекс
+    with op.batch_alter_table('track', schema=None) as batch_op:
+        batch_op.create_index('idx_track_playlist_active',
+                              ['playlist_id', 'is_removed', 'service_track_id'], unique=False)
+
+    # Последние непрочитанные уведомления пользователя
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.create_index('idx_notification_user_unread',
+                              ['user_id', 'is_read', 'created_at'], unique=False)
+
+    # Поиск уже добавленного плейлиста и плейлисты пользователя
+    with op.batch_alter_table('playlist', schema=None) as batch_op:
+        batch_op.create_index('idx_playlist_user_service',
+                              ['user_id', 'service', 'service_playlist_id'], unique=False)
+
+    # Постраничная история уведомлений пользователя
+    with op.batch_alter_table('notification_history', schema=None) as batch_op:
+        batch_op.create_index('idx_notification_history_user_sent',
+                              ['user_id', 'sent_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('notification_history', schema=None) as batch_op:
+        batch_op.drop_index('idx_notification_history_user_sent')
+
+    with op.batch_alter_table('playlist', schema=None) as batch_op:
+        batch_op.drop_index('idx_playlist_user_service')
+
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.drop_index('idx_notification_user_unread')
+
+    with op.batch_alter_table('track', schema=None) as batch_op:
+        batch_op.drop_index('idx_track_playlist_active')
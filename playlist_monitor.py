@@ -1,9 +1,21 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from services.spotify_service import SpotifyService
+from services.spotify_token_manager import SpotifyTokenManager
 from services.deezer_service import DeezerService
 from services.apple_music_service import AppleMusicService
 from services.yandex_music_service import YandexMusicService
+from services.bulk_loader import bulk_loader
+import json
 import logging
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from sqlalchemy import and_, insert, or_, update
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -14,15 +26,57 @@ db = None
 User = None
 Playlist = None
 Track = None
+CatalogTrack = None
 Notification = None
+NotificationHistory = None
+NotificationOutbox = None
+CheckTask = None
+PlaylistVersion = None
 SpotifyToken = None
 DeezerToken = None
 AppleMusicToken = None
 YandexMusicToken = None
 
+# Ограничения параллелизма по умолчанию (сколько плейлистов одного сервиса
+# проверяется одновременно)
+DEFAULT_SERVICE_LIMITS = {
+    'spotify': 4,
+    'deezer': 2,
+    'apple_music': 4,
+    'yandex_music': 2
+}
+
+# Размер пачки ID в одном IN (...) / INSERT: держимся ниже лимита
+# параметров запроса SQLite
+BULK_CHUNK_SIZE = 500
+
+# Сервисы, публичные плейлисты которых читаются без токена пользователя.
+# У Яндекс.Музыки в проекте есть только публичный API.
+PUBLIC_SERVICES = ('deezer', 'yandex_music')
+
+
+def _parse_service_limits(value):
+    """Разобрать строку вида 'spotify=4,deezer=2' в словарь лимитов"""
+    limits = {}
+    for item in (value or '').split(','):
+        if '=' not in item:
+            continue
+        name, limit = item.split('=', 1)
+        try:
+            limits[name.strip()] = max(1, int(limit))
+        except ValueError:
+            logger.warning(f"Некорректный лимит параллелизма для сервиса {name.strip()}: {limit}")
+    return limits
+
+
+def _chunked(items, size):
+    """Разбить список на части не длиннее size"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
 
 class PlaylistMonitor:
-    def __init__(self, app=None):
+    def __init__(self, app=None, max_workers=None, service_limits=None):
         self.app = None
         self.services = {
             'spotify': SpotifyService(),
@@ -30,6 +84,51 @@ class PlaylistMonitor:
             'apple_music': AppleMusicService(),
             'yandex_music': YandexMusicService()
         }
+        # Кэш токенов Spotify с упреждающим обновлением
+        self.spotify_tokens = SpotifyTokenManager(self.services['spotify'])
+        
+        # Настройки параллельной проверки: глобальный лимит потоков
+        # и отдельные лимиты для каждого сервиса
+        if max_workers is None:
+            max_workers = int(os.environ.get('CHECK_MAX_WORKERS', 8))
+        self.max_workers = max(1, max_workers)
+        
+        self.service_limits = dict(DEFAULT_SERVICE_LIMITS)
+        self.service_limits.update(_parse_service_limits(os.environ.get('CHECK_SERVICE_LIMITS')))
+        if service_limits:
+            self.service_limits.update(service_limits)
+        self._service_semaphores = {
+            name: threading.BoundedSemaphore(limit)
+            for name, limit in self.service_limits.items()
+        }
+        
+        # Настройки адаптивного расписания проверок
+        self.schedule_config = {
+            'min_interval_hours': float(os.environ.get('CHECK_MIN_INTERVAL_HOURS', 1)),
+            'max_interval_hours': float(os.environ.get('CHECK_MAX_INTERVAL_HOURS', 72)),
+            'default_interval_hours': float(os.environ.get('CHECK_DEFAULT_INTERVAL_HOURS', 24)),
+            # Вес последнего наблюдения в затухающем среднем частоты изменений
+            'rate_decay': float(os.environ.get('CHECK_RATE_DECAY', 0.3)),
+            # Сколько изменений в среднем должно накапливаться между проверками
+            'target_changes': float(os.environ.get('CHECK_TARGET_CHANGES', 1)),
+            # Сколько плейлистов забирается из очереди за один проход планировщика
+            'batch_size': int(os.environ.get('CHECK_BATCH_SIZE', 200))
+        }
+        
+        # Настройки распределенной проверки через таблицу задач check_task
+        self.task_config = {
+            # Срок аренды задачи: после него задачу упавшего воркера забирает другой
+            'lease_seconds': int(os.environ.get('CHECK_TASK_LEASE_SECONDS', 600)),
+            'max_attempts': int(os.environ.get('CHECK_TASK_MAX_ATTEMPTS', 3)),
+            'poll_seconds': float(os.environ.get('CHECK_WORKER_POLL_SECONDS', 10)),
+            # Сколько часов хранить завершенные задачи
+            'retention_hours': float(os.environ.get('CHECK_TASK_RETENTION_HOURS', 24))
+        }
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        
+        # История состава плейлистов: полный список треков сохраняется раз
+        # в checkpoint_interval версий, между ними - только изменения
+        self.checkpoint_interval = max(1, int(os.environ.get('PLAYLIST_CHECKPOINT_INTERVAL', 50)))
         
         if app is not None:
             self.init_app(app)
@@ -41,14 +140,20 @@ class PlaylistMonitor:
     
     def _init_models(self):
         """Инициализация моделей базы данных"""
-        global db, User, Playlist, Track, Notification
+        global db, User, Playlist, Track, CatalogTrack, Notification, NotificationHistory, NotificationOutbox, CheckTask
+        global PlaylistVersion
         global SpotifyToken, DeezerToken, AppleMusicToken, YandexMusicToken
         
         if self.app:
             with self.app.app_context():
                 from app import (db as app_db, User as app_User,
                                 Playlist as app_Playlist, Track as app_Track,
+                                CatalogTrack as app_CatalogTrack,
                                 Notification as app_Notification,
+                                NotificationHistory as app_NotificationHistory,
+                                NotificationOutbox as app_NotificationOutbox,
+                                CheckTask as app_CheckTask,
+                                PlaylistVersion as app_PlaylistVersion,
                                 SpotifyToken as app_SpotifyToken,
                                 DeezerToken as app_DeezerToken,
                                 AppleMusicToken as app_AppleMusicToken,
@@ -58,7 +163,12 @@ class PlaylistMonitor:
                 User = app_User
                 Playlist = app_Playlist
                 Track = app_Track
+                CatalogTrack = app_CatalogTrack
                 Notification = app_Notification
+                NotificationHistory = app_NotificationHistory
+                NotificationOutbox = app_NotificationOutbox
+                CheckTask = app_CheckTask
+                PlaylistVersion = app_PlaylistVersion
                 SpotifyToken = app_SpotifyToken
                 DeezerToken = app_DeezerToken
                 AppleMusicToken = app_AppleMusicToken
@@ -76,14 +186,352 @@ class PlaylistMonitor:
     
     def _check_all_playlists_impl(self):
         """Внутренняя реализация проверки всех плейлистов"""
-        users = User.query.all()
-        for user in users:
+        rows = db.session.query(
+            Playlist.id, Playlist.service, Playlist.service_playlist_id, Playlist.user_id
+        ).order_by(Playlist.id).all()
+        self._run_checks(rows)
+    
+    def check_due_playlists(self):
+        """Проверить плейлисты, у которых наступило время следующей проверки"""
+        if self.app:
+            with self.app.app_context():
+                self._check_due_playlists_impl()
+        else:
+            self._check_due_playlists_impl()
+    
+    def _check_due_playlists_impl(self):
+        """Внутренняя реализация проверки плейлистов по расписанию"""
+        rows = self._load_due_rows()
+        if not rows:
+            return
+        
+        logger.info(f"Плейлистов к проверке по расписанию: {len(rows)}")
+        self._run_checks(rows)
+    
+    def _load_due_rows(self):
+        """Выбрать плейлисты, у которых наступило время проверки.
+        
+        Индекс по next_check_at работает как очередь с приоритетами: за один
+        проход забираются самые просроченные плейлисты, остальные ждут
+        следующего прохода планировщика.
+        """
+        columns = (Playlist.id, Playlist.service, Playlist.service_playlist_id, Playlist.user_id)
+        now = datetime.utcnow()
+        rows = db.session.query(*columns).filter(
+            or_(Playlist.next_check_at.is_(None), Playlist.next_check_at <= now)
+        ).order_by(
+            Playlist.next_check_at.asc().nulls_first()
+        ).limit(self.schedule_config['batch_size']).all()
+        
+        if not rows:
+            return rows
+        
+        # Публичный плейлист загружается один раз для всех подписчиков,
+        # поэтому проверяем сразу всех, даже если их срок еще не наступил
+        due_ids = {row.id for row in rows}
+        shared = {(row.service, row.service_playlist_id) for row in rows if row.service in PUBLIC_SERVICES}
+        for service, service_playlist_id in shared:
+            for row in db.session.query(*columns).filter_by(service=service, service_playlist_id=service_playlist_id):
+                if row.id not in due_ids:
+                    due_ids.add(row.id)
+                    rows.append(row)
+        
+        return rows
+    
+    def _run_checks(self, rows):
+        """Проверить плейлисты (строки id, service, service_playlist_id, user_id)"""
+        groups = [playlist_ids for _, playlist_ids in self._group_playlists(rows)]
+        
+        if self.max_workers <= 1 or not self.app:
+            failed = sum(1 for group in groups if not self._check_playlist_group(group))
+        else:
+            failed = 0
+            with ThreadPoolExecutor(max_workers=self.max_workers,
+                                    thread_name_prefix='playlist-check') as executor:
+                futures = [executor.submit(self._check_playlist_group_worker, group)
+                           for group in groups]
+                for future in as_completed(futures):
+                    if not future.result():
+                        failed += 1
+        
+        logger.info(f"Проверка плейлистов завершена. Плейлистов: {len(rows)}, "
+                    f"запросов к сервисам: {len(groups)}, с ошибками: {failed}")
+    
+    def _group_playlists(self, rows):
+        """Сгруппировать плейлисты, которые можно проверить одним запросом к сервису.
+        
+        Публичные плейлисты (Deezer, Яндекс.Музыка) загружаются без токена, поэтому
+        все подписчики одного плейлиста получают один общий ответ. Плейлисты,
+        требующие токена, остаются отдельными группами, чтобы данные приватного
+        плейлиста не попадали к пользователю через чужой токен.
+        
+        Возвращает список пар (ключ группы, ID плейлистов).
+        """
+        groups = {}
+        for playlist_id, service, service_playlist_id, user_id in rows:
+            if service in PUBLIC_SERVICES:
+                key = f"{service}:{service_playlist_id}"
+            else:
+                key = f"{service}:{service_playlist_id}:{user_id}"
+            groups.setdefault((service, key), []).append(playlist_id)
+        
+        return self._interleave_by_service(
+            (service, (key, playlist_ids)) for (service, key), playlist_ids in groups.items()
+        )
+    
+    def _interleave_by_service(self, items):
+        """Чередовать задачи разных сервисов, чтобы потоки пула не простаивали
+        в ожидании лимита одного сервиса"""
+        by_service = {}
+        for service, item in items:
+            by_service.setdefault(service, []).append(item)
+        
+        queues = list(by_service.values())
+        result = []
+        for index in range(max((len(queue) for queue in queues), default=0)):
+            for queue in queues:
+                if index < len(queue):
+                    result.append(queue[index])
+        return result
+    
+    @contextmanager
+    def _service_slot(self, service_name):
+        """Занять слот в лимите параллельных запросов к сервису"""
+        semaphore = self._service_semaphores.get(service_name)
+        if semaphore is None:
+            yield
+            return
+        with semaphore:
+            yield
+    
+    def _check_playlist_group_worker(self, playlist_ids):
+        """Проверить группу плейлистов в рабочем потоке.
+        
+        Каждый поток открывает собственный контекст приложения, поэтому
+        Flask-SQLAlchemy выдает ему отдельную сессию БД, которая закрывается
+        вместе с контекстом.
+        """
+        with self.app.app_context():
+            return self._check_playlist_group(playlist_ids)
+    
+    def _check_playlist_group(self, playlist_ids):
+        """Загрузить треки плейлиста из сервиса один раз и применить изменения
+        ко всем подписанным на него плейлистам"""
+        playlists = Playlist.query.filter(Playlist.id.in_(playlist_ids)).order_by(Playlist.id).all()
+        if not playlists:
+            return True
+        
+        # Ответ "не изменился" относится к состоянию, сохраненному у первого
+        # плейлиста группы, поэтому условный запрос допустим, только если
+        # у всех подписчиков сохранено одно и то же состояние
+        source = playlists[0]
+        conditional = len({(p.etag, p.last_modified, p.content_hash) for p in playlists}) == 1
+        try:
+            fetch_result, diffs = self._fetch_and_diff(playlists, conditional)
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке плейлиста {source.name} ({source.service}): {str(e)}")
+            self._postpone_checks(playlists, self.schedule_config['min_interval_hours'])
+            return False
+        
+        if fetch_result is None:
+            self._postpone_checks(playlists, self.schedule_config['default_interval_hours'])
+            return True
+        
+        success = True
+        for playlist in playlists:
             try:
-                self.check_user_playlists(user)
+                self._apply_track_changes(playlist, fetch_result, diffs.get(playlist.id))
             except Exception as e:
-                logger.error(f"Ошибка при проверке плейлистов пользователя {user.username}: {str(e)}")
+                logger.error(f"Ошибка при проверке плейлиста {playlist.name}: {str(e)}")
+                db.session.rollback()
+                success = False
         
-        logger.info("Проверка всех плейлистов завершена")
+        return success
+    
+    def enqueue_due_checks(self):
+        """Поставить в очередь check_task задачи для плейлистов, у которых
+        наступило время проверки. Задачи выполняют воркеры (run_worker),
+        запущенные на любом количестве хостов."""
+        if self.app:
+            with self.app.app_context():
+                return self._enqueue_due_checks_impl()
+        return self._enqueue_due_checks_impl()
+    
+    def _enqueue_due_checks_impl(self):
+        """Внутренняя реализация постановки задач проверки в очередь"""
+        now = datetime.utcnow()
+        try:
+            self._cleanup_tasks(now)
+            
+            groups = self._group_playlists(self._load_due_rows())
+            if not groups:
+                db.session.commit()
+                return 0
+            
+            # Группа, по которой уже есть незавершенная задача, повторно не ставится
+            queued = set()
+            for keys in _chunked([key for key, _ in groups], BULK_CHUNK_SIZE):
+                queued.update(key for (key,) in db.session.query(CheckTask.group_key).filter(
+                    CheckTask.group_key.in_(keys),
+                    CheckTask.status.in_(('pending', 'running'))
+                ))
+            
+            tasks = [
+                {
+                    'group_key': key,
+                    'service': key.split(':', 1)[0],
+                    'playlist_ids': json.dumps(playlist_ids),
+                    'status': 'pending',
+                    'attempts': 0,
+                    'created_at': now
+                }
+                for key, playlist_ids in groups if key not in queued
+            ]
+            for chunk in _chunked(tasks, BULK_CHUNK_SIZE):
+                db.session.execute(insert(CheckTask), chunk)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        
+        logger.info(f"Задач проверки поставлено в очередь: {len(tasks)} "
+                    f"(уже в очереди: {len(groups) - len(tasks)})")
+        return len(tasks)
+    
+    def _cleanup_tasks(self, now):
+        """Закрыть задачи, исчерпавшие попытки, и удалить давно завершенные"""
+        db.session.query(CheckTask).filter(
+            CheckTask.status == 'running',
+            CheckTask.lease_expires_at < now,
+            CheckTask.attempts >= self.task_config['max_attempts']
+        ).update({
+            'status': 'failed',
+            'finished_at': now,
+            'last_error': 'Аренда истекла, попытки исчерпаны'
+        }, synchronize_session=False)
+        
+        db.session.query(CheckTask).filter(
+            CheckTask.status.in_(('done', 'failed')),
+            CheckTask.finished_at < now - timedelta(hours=self.task_config['retention_hours'])
+        ).delete(synchronize_session=False)
+    
+    def run_worker(self, once=False, threads=None):
+        """Забирать задачи из check_task и выполнять их.
+        
+        Каждый поток воркера в цикле берет одну задачу в аренду и проверяет
+        ее группу плейлистов. Воркеры на разных хостах работают с одной
+        таблицей, поэтому добавление хоста почти линейно ускоряет цикл.
+        С once=True воркер завершается, когда очередь опустеет.
+        """
+        if not self.app:
+            raise RuntimeError("Воркеру проверки нужно Flask приложение")
+        
+        threads = max(1, threads or self.max_workers)
+        logger.info(f"Воркер проверки {self.worker_id} запущен, потоков: {threads}")
+        
+        with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='check-worker') as executor:
+            futures = [executor.submit(self._worker_loop, once) for _ in range(threads)]
+            processed = sum(future.result() for future in futures)
+        
+        logger.info(f"Воркер проверки {self.worker_id} остановлен, выполнено задач: {processed}")
+        return processed
+    
+    def _worker_loop(self, once):
+        """Цикл одного потока воркера: забрать задачу, выполнить, повторить"""
+        processed = 0
+        while True:
+            with self.app.app_context():
+                try:
+                    tasks = self._claim_tasks(1)
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Ошибка при получении задачи проверки: {str(e)}")
+                    tasks = []
+                
+                for task_id, playlist_ids, claim_owner in tasks:
+                    self._process_task(task_id, playlist_ids, claim_owner)
+                    processed += 1
+            
+            if not tasks:
+                if once:
+                    return processed
+                time.sleep(self.task_config['poll_seconds'])
+    
+    def _claim_tasks(self, limit):
+        """Взять в аренду до limit задач. Возвращает [(id, ID плейлистов, владелец)].
+        
+        На PostgreSQL строки выбираются через SELECT ... FOR UPDATE SKIP LOCKED,
+        поэтому воркеры не ждут друг друга и не получают одну задачу дважды.
+        В SQLite запись в базу и так сериализована, и задачи забираются одним
+        условным UPDATE: строку получает тот, чей UPDATE выполнился первым.
+        Каждая выдача помечается уникальным владельцем, по которому воркер
+        находит свои задачи и завершает только их.
+        """
+        now = datetime.utcnow()
+        claimable = and_(
+            CheckTask.attempts < self.task_config['max_attempts'],
+            or_(
+                CheckTask.status == 'pending',
+                and_(CheckTask.status == 'running', CheckTask.lease_expires_at < now)
+            )
+        )
+        claim_owner = f"{self.worker_id}:{uuid.uuid4().hex[:12]}"
+        values = {
+            'status': 'running',
+            'lease_owner': claim_owner,
+            'lease_expires_at': now + timedelta(seconds=self.task_config['lease_seconds']),
+            'attempts': CheckTask.attempts + 1
+        }
+        
+        candidates = db.session.query(CheckTask.id).filter(claimable).order_by(CheckTask.id).limit(limit)
+        if db.engine.dialect.name == 'postgresql':
+            task_ids = [task_id for (task_id,) in candidates.with_for_update(skip_locked=True)]
+            if task_ids:
+                db.session.query(CheckTask).filter(CheckTask.id.in_(task_ids)).update(
+                    values, synchronize_session=False)
+        else:
+            db.session.query(CheckTask).filter(
+                CheckTask.id.in_(candidates.scalar_subquery()), claimable
+            ).update(values, synchronize_session=False)
+        db.session.commit()
+        
+        tasks = db.session.query(CheckTask.id, CheckTask.playlist_ids).filter_by(
+            lease_owner=claim_owner, status='running'
+        ).all()
+        return [(task_id, json.loads(playlist_ids), claim_owner) for task_id, playlist_ids in tasks]
+    
+    def _process_task(self, task_id, playlist_ids, claim_owner):
+        """Проверить группу плейлистов задачи и записать результат"""
+        try:
+            success = self._check_playlist_group(playlist_ids)
+            error = None if success else 'Не удалось проверить часть плейлистов группы'
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Ошибка при выполнении задачи проверки {task_id}: {str(e)}")
+            success = False
+            error = str(e)
+        
+        try:
+            # Если аренда истекла и задачу забрал другой воркер, результат не записываем
+            db.session.query(CheckTask).filter_by(id=task_id, lease_owner=claim_owner).update({
+                'status': 'done' if success else 'failed',
+                'lease_expires_at': None,
+                'finished_at': datetime.utcnow(),
+                'last_error': error
+            }, synchronize_session=False)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Ошибка при завершении задачи проверки {task_id}: {str(e)}")
+        
+        return success
+    
+    def refresh_spotify_tokens(self):
+        """Заранее обновить токены Spotify, которые скоро истекут"""
+        if self.app:
+            with self.app.app_context():
+                return self.spotify_tokens.refresh_expiring()
+        return self.spotify_tokens.refresh_expiring()
     
     def check_user_playlists(self, user):
         """Проверить плейлисты конкретного пользователя"""
@@ -116,213 +564,376 @@ class PlaylistMonitor:
     
     def _check_playlist_impl(self, playlist):
         """Внутренняя реализация проверки плейлиста"""
+        # Плейлист мог быть загружен в сессии другого контекста приложения
+        # (check_user_playlists): изменения его полей фиксируются только
+        # через текущую сессию
+        playlist = db.session.get(Playlist, playlist.id)
+        if playlist is None:
+            return
+        
+        fetch_result, diffs = self._fetch_and_diff([playlist])
+        
+        if fetch_result is not None:
+            self._apply_track_changes(playlist, fetch_result, diffs.get(playlist.id))
+    
+    def _fetch_and_diff(self, playlists, conditional=True):
+        """Загрузить треки плейлиста из сервиса и сравнить их с сохраненными
+        треками всех плейлистов группы за один потоковый проход.
+        
+        Слот сервиса занят на все время прохода, потому что страницы треков
+        загружаются по мере чтения. Сравнение только читает базу: запись идет
+        позже, в _apply_track_changes, одной короткой транзакцией.
+        
+        Возвращает пару (fetch_result, diffs): результат _fetch_current_tracks
+        и состояния сравнения по ID плейлистов (пустой словарь, если плейлист
+        не изменился или его нельзя проверить).
+        """
+        source = playlists[0]
+        try:
+            with self._service_slot(source.service):
+                fetch_result = self._fetch_current_tracks(source, conditional)
+                if fetch_result is None or fetch_result['unchanged']:
+                    return fetch_result, {}
+                return fetch_result, self._diff_track_stream(playlists, fetch_result)
+        except Exception:
+            db.session.rollback()
+            raise
+    
+    def _public_playlist_url(self, playlist):
+        """Собрать URL публичного плейлиста по его ID в сервисе"""
+        if playlist.service == 'deezer':
+            return f"https://www.deezer.com/playlist/{playlist.service_playlist_id}"
+        return f"https://music.yandex.ru/playlists/{playlist.service_playlist_id}"
+    
+    def _fetch_current_tracks(self, playlist, conditional=True):
+        """Получить текущее состояние плейлиста из сервиса.
+        
+        conditional=False отключает условный запрос публичного плейлиста
+        (валидаторы прошлой проверки не отправляются).
+        
+        Возвращает словарь с ключами:
+            tracks    - итератор по трекам или None, если плейлист не изменился
+                        или загружены только ID
+            track_ids - (компактный режим) итератор по ID треков плейлиста
+            hydrate   - (компактный режим) функция, загружающая данные треков по ID
+            unchanged - True, если сервис подтвердил, что плейлист не менялся
+            state     - значения полей Playlist, которые нужно сохранить после проверки
+        Возвращает None, если плейлист проверить нельзя (нет сервиса или токена).
+        """
         service = self.services.get(playlist.service)
         if not service:
             logger.error(f"Сервис {playlist.service} не найден")
-            return
+            return None
         
-        # Для публичных плейлистов Яндекс.Музыки и Deezer не нужен токен
-        if playlist.service == 'deezer':
-            try:
-                # Получаем треки плейлиста Deezer через RapidAPI
-                playlist_url = f"https://www.deezer.com/playlist/{playlist.service_playlist_id}"
-                current_tracks = service.get_public_playlist_tracks(playlist_url)
-                current_track_ids = {track['id'] for track in current_tracks}
-                
-                # Получаем треки из базы данных
-                db_tracks = Track.query.filter_by(playlist_id=playlist.id, is_removed=False).all()
-                db_track_ids = {track.service_track_id for track in db_tracks}
-                
-                # Находим удаленные треки
-                removed_track_ids = db_track_ids - current_track_ids
-                if removed_track_ids:
-                    self._handle_removed_tracks(playlist, removed_track_ids)
-                
-                # Находим новые треки
-                new_track_ids = current_track_ids - db_track_ids
-                if new_track_ids:
-                    self._handle_new_tracks(playlist, current_tracks, new_track_ids)
-                
-                # Обновляем время последней проверки
-                playlist.last_checked = datetime.utcnow()
-                try:
-                    db.session.commit()
-                    logger.info(f"Время последней проверки плейлиста Deezer {playlist.name} обновлено")
-                except Exception as e:
-                    logger.error(f"Ошибка при обновлении времени проверки плейлиста Deezer {playlist.name}: {str(e)}")
-                    db.session.rollback()
-                    raise
-                
-                logger.info(f"Плейлист Deezer {playlist.name} проверен. Удалено: {len(removed_track_ids)}, добавлено: {len(new_track_ids)}")
-                
-            except Exception as e:
-                logger.error(f"Ошибка при проверке плейлиста Deezer {playlist.name}: {str(e)}")
+        # Для публичных плейлистов Яндекс.Музыки и Deezer не нужен токен.
+        # Запрос условный: если ответ не изменился, разбор и сравнение пропускаются
+        if playlist.service in PUBLIC_SERVICES:
+            validators = {}
+            if conditional:
+                validators = {
+                    'etag': playlist.etag,
+                    'last_modified': playlist.last_modified,
+                    'content_hash': playlist.content_hash
+                }
+            return service.get_public_playlist(
+                self._public_playlist_url(playlist), **validators)
+        
+        # Получаем токен доступа для сервиса
+        access_token = self._get_user_token(playlist.user, playlist.service)
+        if not access_token:
+            logger.warning(f"Нет токена доступа для {playlist.service} у пользователя {playlist.user.username}")
+            return None
+        
+        # Получаем refresh_token для Spotify
+        refresh_token = None
+        if playlist.service == 'spotify':
+            refresh_token = self.spotify_tokens.get_refresh_token(playlist.user_id)
+        
+        try:
+            return self._fetch_with_token(service, playlist, access_token, refresh_token)
+        except Exception as e:
+            # Импортируем TokenExpiredError локально, чтобы избежать циклических импортов
+            from services.spotify_service import TokenExpiredError
+            
+            if not (isinstance(e, TokenExpiredError) and e.new_token_info and playlist.service == 'spotify'):
                 raise
-        elif playlist.service == 'yandex_music' and hasattr(playlist, 'is_public') and playlist.is_public:
-            try:
-                # Получаем треки публичного плейлиста
-                playlist_url = f"https://music.yandex.ru/playlists/{playlist.service_playlist_id}"
-                current_tracks = service.get_public_playlist_tracks(playlist_url)
-                current_track_ids = {track['id'] for track in current_tracks}
-                
-                # Получаем треки из базы данных
-                db_tracks = Track.query.filter_by(playlist_id=playlist.id, is_removed=False).all()
-                db_track_ids = {track.service_track_id for track in db_tracks}
-                
-                # Находим удаленные треки
-                removed_track_ids = db_track_ids - current_track_ids
-                if removed_track_ids:
-                    self._handle_removed_tracks(playlist, removed_track_ids)
-                
-                # Находим новые треки
-                new_track_ids = current_track_ids - db_track_ids
-                if new_track_ids:
-                    self._handle_new_tracks(playlist, current_tracks, new_track_ids)
-                
-                # Обновляем время последней проверки
-                playlist.last_checked = datetime.utcnow()
-                try:
-                    db.session.commit()
-                    logger.info(f"Время последней проверки публичного плейлиста {playlist.name} обновлено")
-                except Exception as e:
-                    logger.error(f"Ошибка при обновлении времени проверки публичного плейлиста {playlist.name}: {str(e)}")
-                    db.session.rollback()
-                    raise
-                
-                logger.info(f"Публичный плейлист {playlist.name} проверен. Удалено: {len(removed_track_ids)}, добавлено: {len(new_track_ids)}")
-                
-            except Exception as e:
-                logger.error(f"Ошибка при проверке публичного плейлиста {playlist.name}: {str(e)}")
+            
+            # Токен отозван раньше срока: менеджер токенов заранее обновляет
+            # истекающие токены, поэтому сюда попадаем только после первого
+            # легкого запроса (snapshot_id), а не посреди загрузки треков
+            if not self.spotify_tokens.store_token(playlist.user_id, e.new_token_info):
                 raise
-        else:
-            # Получаем токен доступа для сервиса
-            access_token = self._get_user_token(playlist.user, playlist.service)
-            if not access_token:
-                logger.warning(f"Нет токена доступа для {playlist.service} у пользователя {playlist.user.username}")
-                return
             
-            # Получаем refresh_token для Spotify
-            refresh_token = None
-            if playlist.service == 'spotify':
-                token_record = playlist.user.spotify_tokens[0] if playlist.user.spotify_tokens else None
-                if token_record:
-                    refresh_token = token_record.refresh_token
+            logger.info(f"Токен обновлен для пользователя {playlist.user.username}, повторяем загрузку плейлиста")
             
-            try:
-                # Получаем текущие треки из плейлиста
-                if playlist.service == 'spotify':
-                    current_tracks = service.get_playlist_tracks(access_token, playlist.service_playlist_id, refresh_token)
-                else:
-                    current_tracks = service.get_playlist_tracks(access_token, playlist.service_playlist_id)
-                current_track_ids = {track['id'] for track in current_tracks}
-                
-                # Получаем треки из базы данных
-                db_tracks = Track.query.filter_by(playlist_id=playlist.id, is_removed=False).all()
-                db_track_ids = {track.service_track_id for track in db_tracks}
-                
-                # Находим удаленные треки
-                removed_track_ids = db_track_ids - current_track_ids
-                if removed_track_ids:
-                    self._handle_removed_tracks(playlist, removed_track_ids)
-                
-                # Находим новые треки
-                new_track_ids = current_track_ids - db_track_ids
-                if new_track_ids:
-                    self._handle_new_tracks(playlist, current_tracks, new_track_ids)
-                
-                # Обновляем время последней проверки
-                playlist.last_checked = datetime.utcnow()
-                try:
-                    db.session.commit()
-                    logger.info(f"Время последней проверки плейлиста {playlist.name} обновлено")
-                except Exception as e:
-                    logger.error(f"Ошибка при обновлении времени проверки плейлиста {playlist.name}: {str(e)}")
-                    db.session.rollback()
-                    raise
-                
-                logger.info(f"Плейлист {playlist.name} проверен. Удалено: {len(removed_track_ids)}, добавлено: {len(new_track_ids)}")
-                
-            except Exception as e:
-                # Импортируем TokenExpiredError локально, чтобы избежать циклических импортов
-                from services.spotify_service import TokenExpiredError
-                
-                if isinstance(e, TokenExpiredError) and e.new_token_info:
-                    # Обновляем токен в базе данных
-                    if playlist.service == 'spotify':
-                        token_record = playlist.user.spotify_tokens[0] if playlist.user.spotify_tokens else None
-                        if token_record:
-                            token_record.access_token = e.new_token_info['access_token']
-                            if 'refresh_token' in e.new_token_info:
-                                token_record.refresh_token = e.new_token_info['refresh_token']
-                            token_record.expires_at = datetime.utcnow() + timedelta(seconds=e.new_token_info['expires_in'])
-                            db.session.commit()
-                            
-                            logger.info(f"Токен обновлен для пользователя {playlist.user.username}, повторяем проверку плейлиста")
-                            
-                            # Повторяем проверку с новым токеном
-                            try:
-                                current_tracks = service.get_playlist_tracks(e.new_token_info['access_token'], playlist.service_playlist_id)
-                                current_track_ids = {track['id'] for track in current_tracks}
-                                
-                                # Получаем треки из базы данных
-                                db_tracks = Track.query.filter_by(playlist_id=playlist.id, is_removed=False).all()
-                                db_track_ids = {track.service_track_id for track in db_tracks}
-                                
-                                # Находим удаленные треки
-                                removed_track_ids = db_track_ids - current_track_ids
-                                if removed_track_ids:
-                                    self._handle_removed_tracks(playlist, removed_track_ids)
-                                
-                                # Находим новые треки
-                                new_track_ids = current_track_ids - db_track_ids
-                                if new_track_ids:
-                                    self._handle_new_tracks(playlist, current_tracks, new_track_ids)
-                                
-                                # Обновляем время последней проверки
-                                playlist.last_checked = datetime.utcnow()
-                                try:
-                                    db.session.commit()
-                                    logger.info(f"Время последней проверки плейлиста {playlist.name} обновлено после обновления токена")
-                                except Exception as e:
-                                    logger.error(f"Ошибка при обновлении времени проверки плейлиста {playlist.name} после обновления токена: {str(e)}")
-                                    db.session.rollback()
-                                    raise
-                                
-                                logger.info(f"Плейлист {playlist.name} проверен после обновления токена. Удалено: {len(removed_track_ids)}, добавлено: {len(new_track_ids)}")
-                                return
-                            except Exception as retry_e:
-                                logger.error(f"Ошибка при повторной проверке плейлиста {playlist.name} после обновления токена: {str(retry_e)}")
-                                raise
+            # Повторяем загрузку с новым токеном
+            return self._fetch_with_token(service, playlist, e.new_token_info['access_token'])
+    
+    def _fetch_with_token(self, service, playlist, access_token, refresh_token=None):
+        """Загрузить треки плейлиста, требующего токена пользователя"""
+        if playlist.service != 'spotify':
+            tracks = service.iter_playlist_tracks(access_token, playlist.service_playlist_id)
+            return {'tracks': tracks, 'unchanged': False, 'state': {}}
+        
+        # Сначала сверяем snapshot_id: если он не изменился, полная
+        # постраничная загрузка треков не нужна
+        snapshot_id = service.get_playlist_snapshot_id(access_token, playlist.service_playlist_id, refresh_token)
+        if snapshot_id and snapshot_id == playlist.snapshot_id:
+            return {'tracks': None, 'unchanged': True, 'state': {}}
+        
+        # Для сравнения достаточно ID треков; данные загружаются только для новых
+        track_ids = service.iter_playlist_track_ids(access_token, playlist.service_playlist_id, refresh_token)
+        return {
+            'tracks': None,
+            'track_ids': track_ids,
+            'hydrate': lambda ids: service.get_tracks_metadata(access_token, ids),
+            'unchanged': False,
+            'state': {'snapshot_id': snapshot_id}
+        }
+    
+    def _diff_track_stream(self, playlists, fetch_result):
+        """Сравнить поток треков из сервиса с сохраненными треками плейлистов.
+        
+        Треки читаются из итератора сервиса по одному, пока следующие страницы
+        еще загружаются. Для поиска удаленных запоминаются только ID, а полные
+        данные - лишь у треков, которых нет в базе. В базу по ходу загрузки
+        ничего не пишется: открытая транзакция записи держала бы блокировку
+        все время сетевых запросов.
+        
+        Возвращает словарь: ID плейлиста -> состояние сравнения.
+        """
+        compact = 'track_ids' in fetch_result
+        # Словарь как упорядоченное множество: порядок треков в плейлисте
+        # нужен контрольной точке истории версий
+        current_ids = {}
+        
+        diffs = {}
+        for playlist in playlists:
+            # Получаем активные треки из базы данных одним запросом
+            db_tracks = db.session.query(
+                Track.id, Track.service_track_id, Track.catalog_track_id
+            ).filter_by(playlist_id=playlist.id, is_removed=False).all()
+            diffs[playlist.id] = {
+                'db_tracks': db_tracks,
+                'db_ids': {track.service_track_id for track in db_tracks},
+                'current_ids': current_ids,
+                'pending': []
+            }
+        
+        for item in fetch_result['track_ids'] if compact else fetch_result['tracks']:
+            track_id = item if compact else item['id']
+            # Дубликаты внутри плейлиста учитываем один раз
+            if track_id in current_ids:
+                continue
+            current_ids[track_id] = None
+            
+            for playlist in playlists:
+                diff = diffs[playlist.id]
+                if track_id in diff['db_ids']:
+                    continue
+                diff['pending'].append(item)
+        
+        return diffs
+    
+    def _apply_track_changes(self, playlist, fetch_result, diff=None):
+        """Применить результат сравнения треков и зафиксировать проверку.
+        
+        diff - состояние сравнения из _diff_track_stream (None, если плейлист
+        не изменился). Данные новых треков догружаются до первой записи, после
+        чего все изменения плейлиста и очередь уведомлений о них фиксируются
+        одной короткой транзакцией без сетевых запросов внутри. Отправкой
+        уведомлений занимается диспетчер очереди.
+        """
+        removed_tracks = []
+        added_ids = []
+        notifications = []
+        now = datetime.utcnow()
+        
+        try:
+            if diff is not None:
+                new_tracks = self._hydrate_new_tracks(playlist, fetch_result, diff['pending'])
+                if new_tracks:
+                    notifications.extend(self._handle_new_tracks(playlist, new_tracks))
+                    added_ids = [track['id'] for track in new_tracks]
                 
-                logger.error(f"Ошибка при проверке плейлиста {playlist.name}: {str(e)}")
-                raise
+                removed_tracks = [track for track in diff['db_tracks']
+                                  if track.service_track_id not in diff['current_ids']]
+                if removed_tracks:
+                    notifications.extend(self._handle_removed_tracks(playlist, removed_tracks))
+                if removed_tracks or added_ids:
+                    self._record_version(
+                        playlist, diff['current_ids'], now, added_ids,
+                        [track.service_track_id for track in removed_tracks]
+                    )
+            
+            if notifications:
+                self._enqueue_notifications(playlist, notifications)
+            
+            for field, value in fetch_result['state'].items():
+                setattr(playlist, field, value)
+            
+            # Обновляем время последней проверки и планируем следующую
+            self._schedule_next_check(playlist, len(removed_tracks) + len(added_ids), now)
+            playlist.last_checked = now
+            db.session.commit()
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении изменений плейлиста {playlist.name}: {str(e)}")
+            db.session.rollback()
+            raise
+        
+        if fetch_result['unchanged']:
+            logger.info(f"Плейлист {playlist.name} не изменился с прошлой проверки")
+        else:
+            logger.info(f"Плейлист {playlist.name} проверен. Удалено: {len(removed_tracks)}, добавлено: {len(added_ids)}")
+    
+    def _hydrate_new_tracks(self, playlist, fetch_result, pending):
+        """Получить полные данные новых треков.
+        
+        При полной загрузке они уже есть в ответе сервиса. В компактном режиме
+        сервис вернул только ID, и метаданные догружаются пачками лишь для
+        треков, которых еще нет в базе.
+        """
+        hydrate = fetch_result.get('hydrate')
+        if hydrate is None:
+            return pending
+        
+        # Треки, которые уже есть в каталоге (например, в чужих плейлистах),
+        # у сервиса не запрашиваем
+        tracks_by_id = {
+            service_track_id: {
+                'id': service_track_id,
+                'name': row.name,
+                'artist': row.artist,
+                'album': row.album,
+                'duration': row.duration,
+                'added_at': None
+            }
+            for service_track_id, row in self._load_catalog_tracks(playlist.service, pending).items()
+        }
+        missing = [track_id for track_id in pending if track_id not in tracks_by_id]
+        if missing:
+            with self._service_slot(playlist.service):
+                hydrated = hydrate(missing)
+            tracks_by_id.update(zip(missing, hydrated))
+        
+        return [tracks_by_id[track_id] for track_id in pending]
+    
+    def _load_catalog_tracks(self, service, service_track_ids):
+        """Найти треки сервиса в каталоге: ID трека в сервисе -> строка каталога"""
+        rows = {}
+        for chunk in _chunked(list(service_track_ids), BULK_CHUNK_SIZE):
+            rows.update((row.service_track_id, row) for row in db.session.query(
+                CatalogTrack.id, CatalogTrack.service_track_id, CatalogTrack.name,
+                CatalogTrack.artist, CatalogTrack.album, CatalogTrack.duration
+            ).filter(CatalogTrack.service == service, CatalogTrack.service_track_id.in_(chunk)))
+        return rows
+    
+    def _catalog_track_ids(self, service, tracks):
+        """Получить ID треков в каталоге, добавив туда треки, которых в нем нет.
+        
+        Данные трека записываются только при первом его появлении в любом
+        плейлисте. Если тот же трек одновременно добавляет другой процесс,
+        конфликт по уникальному индексу пропускается, и берется его запись.
+        Возвращает словарь: ID трека в сервисе -> ID в каталоге.
+        """
+        tracks_by_id = {}
+        for track in tracks:
+            tracks_by_id.setdefault(track['id'], track)
+        
+        catalog_ids = {service_track_id: row.id for service_track_id, row
+                       in self._load_catalog_tracks(service, tracks_by_id).items()}
+        missing = [track for track_id, track in tracks_by_id.items() if track_id not in catalog_ids]
+        if not missing:
+            return catalog_ids
+        
+        created_at = datetime.utcnow()
+        rows = [{
+            'service': service,
+            'service_track_id': track['id'],
+            'name': track['name'],
+            'artist': track['artist'],
+            'album': track.get('album', ''),
+            'duration': track.get('duration', 0),
+            'created_at': created_at
+        } for track in missing]
+        bulk_loader.insert(db.session, CatalogTrack.__table__, rows,
+                           conflict_columns=['service', 'service_track_id'])
+        
+        catalog_ids.update((service_track_id, row.id) for service_track_id, row
+                           in self._load_catalog_tracks(service, [track['id'] for track in missing]).items())
+        return catalog_ids
+    
+    def _insert_tracks(self, playlist, tracks, added_at):
+        """Записать треки в плейлист пакетной вставкой (см. bulk_loader).
+        
+        Данные треков пишутся в каталог только для треков, которых там еще
+        нет. Трек, который уже есть среди активных треков плейлиста (повтор в
+        ответе сервиса или запись параллельной проверки), пропускается.
+        Возвращает словарь: ID трека в сервисе -> ID записи трека для
+        действительно добавленных треков.
+        """
+        catalog_ids = self._catalog_track_ids(playlist.service, tracks)
+        rows = [{
+            'playlist_id': playlist.id,
+            'catalog_track_id': catalog_ids[track_data['id']],
+            'service_track_id': track_data['id'],
+            'added_at': added_at,
+            'is_removed': False
+        } for track_data in tracks]
+        
+        inserted = bulk_loader.insert(
+            db.session, Track.__table__, rows,
+            conflict_columns=['playlist_id', 'service_track_id'],
+            conflict_where=Track.is_removed == False,
+            returning=(Track.id, Track.service_track_id)
+        )
+        track_ids = {service_track_id: track_id for track_id, service_track_id in inserted}
+        self._update_track_counters(playlist, added=len(track_ids))
+        return track_ids
+    
+    def _schedule_next_check(self, playlist, changes, now):
+        """Пересчитать частоту изменений плейлиста и время следующей проверки.
+        
+        Частота изменений (добавлений и удалений в час) сглаживается
+        экспоненциально затухающим средним. Интервал подбирается так, чтобы
+        между проверками накапливалось около target_changes изменений, и
+        ограничивается min/max интервалом. Небольшой случайный разброс
+        распределяет проверки по суткам.
+        """
+        config = self.schedule_config
+        if playlist.last_checked:
+            elapsed_hours = (now - playlist.last_checked).total_seconds() / 3600
+        else:
+            elapsed_hours = config['default_interval_hours']
+        elapsed_hours = max(elapsed_hours, config['min_interval_hours'])
+        
+        observed_rate = changes / elapsed_hours
+        rate = config['rate_decay'] * observed_rate + (1 - config['rate_decay']) * (playlist.change_rate or 0.0)
+        
+        if rate > 0:
+            interval_hours = config['target_changes'] / rate
+        else:
+            interval_hours = config['max_interval_hours']
+        interval_hours = min(max(interval_hours, config['min_interval_hours']), config['max_interval_hours'])
+        
+        playlist.change_rate = rate
+        playlist.next_check_at = now + timedelta(hours=interval_hours * random.uniform(0.9, 1.1))
+    
+    def _postpone_checks(self, playlists, hours):
+        """Отложить проверку плейлистов, которые сейчас проверить не удалось"""
+        next_check_at = datetime.utcnow() + timedelta(hours=hours)
+        try:
+            for playlist in playlists:
+                playlist.next_check_at = next_check_at
+            db.session.commit()
+        except Exception as e:
+            logger.error(f"Ошибка при переносе проверки плейлистов: {str(e)}")
+            db.session.rollback()
     
     def _get_user_token(self, user, service_name):
         """Получить токен доступа пользователя для сервиса"""
         if service_name == 'spotify':
-            token_record = user.spotify_tokens[0] if user.spotify_tokens else None
-            if token_record:
-                # Проверяем, не истек ли токен
-                if token_record.expires_at > datetime.utcnow():
-                    return token_record.access_token
-                else:
-                    # Токен истек, пытаемся обновить
-                    try:
-                        service = self.services['spotify']
-                        new_token_info = service.refresh_access_token(token_record.refresh_token)
-                        
-                        # Обновляем токен в базе данных
-                        token_record.access_token = new_token_info['access_token']
-                        if 'refresh_token' in new_token_info:
-                            token_record.refresh_token = new_token_info['refresh_token']
-                        token_record.expires_at = datetime.utcnow() + timedelta(seconds=new_token_info['expires_in'])
-                        db.session.commit()
-                        
-                        logger.info(f"Токен Spotify для пользователя {user.username} успешно обновлен")
-                        return token_record.access_token
-                    except Exception as e:
-                        logger.error(f"Ошибка обновления токена Spotify для пользователя {user.username}: {str(e)}")
-                        return None
+            return self.spotify_tokens.get_access_token(user.id)
         elif service_name == 'deezer':
             token_record = user.deezer_tokens[0] if user.deezer_tokens else None
             if token_record and token_record.expires_at > datetime.utcnow():
@@ -338,166 +949,228 @@ class PlaylistMonitor:
         
         return None
     
-    def _handle_removed_tracks(self, playlist, removed_track_ids):
-        """Обработать удаленные треки"""
-        if self.app:
-            with self.app.app_context():
-                self._handle_removed_tracks_impl(playlist, removed_track_ids)
-        else:
-            self._handle_removed_tracks_impl(playlist, removed_track_ids)
+    def _handle_removed_tracks(self, playlist, removed_tracks):
+        """Отметить удаленные треки одним UPDATE на пачку ID.
+        
+        Трек, который уже отметила параллельная проверка того же плейлиста,
+        не учитывается повторно: счетчики и уведомления считаются только по
+        строкам, которые изменил этот UPDATE.
+        Возвращает данные для отправки уведомлений после фиксации транзакции.
+        """
+        removed_at = datetime.utcnow()
+        removed_ids = set()
+        for chunk in _chunked([track.id for track in removed_tracks], BULK_CHUNK_SIZE):
+            removed_ids.update(track_id for (track_id,) in db.session.execute(
+                update(Track).where(Track.id.in_(chunk), Track.is_removed == False)
+                .values(is_removed=True, removed_at=removed_at).returning(Track.id),
+                execution_options={'synchronize_session': False}
+            ))
+        removed_tracks = [track for track in removed_tracks if track.id in removed_ids]
+        if not removed_tracks:
+            return []
+        
+        # Названия удаленных треков для уведомлений берем из каталога
+        catalog = {}
+        for chunk in _chunked([track.catalog_track_id for track in removed_tracks], BULK_CHUNK_SIZE):
+            catalog.update((row.id, row) for row in db.session.query(
+                CatalogTrack.id, CatalogTrack.name, CatalogTrack.artist
+            ).filter(CatalogTrack.id.in_(chunk)))
+        
+        notification_rows = []
+        notifications = []
+        for track in removed_tracks:
+            catalog_track = catalog[track.catalog_track_id]
+            message = f"Трек '{catalog_track.name}' от {catalog_track.artist} был удален из плейлиста '{playlist.name}'"
+            notification_rows.append({
+                'user_id': playlist.user_id,
+                'playlist_id': playlist.id,
+                'track_id': track.id,
+                'message': message,
+                'is_read': False,
+                'created_at': removed_at
+            })
+            notifications.append({
+                'type': 'track_removed',
+                'message': message,
+                'track_service_id': track.service_track_id,
+                'track_name': catalog_track.name,
+                'artist_name': catalog_track.artist,
+                'playlist_name': playlist.name,
+                'playlist_id': playlist.id
+            })
+        
+        db.session.execute(insert(Notification), notification_rows)
+        self._update_track_counters(playlist, removed=len(removed_tracks))
+        logger.info(f"Отмечено удаленными {len(removed_tracks)} треков в плейлисте {playlist.name}")
+        return notifications
     
-    def _handle_removed_tracks_impl(self, playlist, removed_track_ids):
-        """Внутренняя реализация обработки удаленных треков"""
-        try:
-            for track_id in removed_track_ids:
-                track = Track.query.filter_by(
-                    playlist_id=playlist.id,
-                    service_track_id=track_id,
-                    is_removed=False
-                ).first()
-                
-                if track:
-                    logger.info(f"Найден трек для удаления: {track.name} (ID: {track.id})")
-                    
-                    # Отмечаем трек как удаленный
-                    track.is_removed = True
-                    track.removed_at = datetime.utcnow()
-                    
-                    # Создаем уведомление
-                    notification = Notification(
-                        user_id=playlist.user_id,
-                        playlist_id=playlist.id,
-                        track_id=track.id,
-                        message=f"Трек '{track.name}' от {track.artist} был удален из плейлиста '{playlist.name}'"
-                    )
-                    db.session.add(notification)
-                    
-                    # Отправляем уведомления по всем каналам
-                    try:
-                        from services.notification_service import notification_service
-                        
-                        notification_data = {
-                            'type': 'track_removed',
-                            'message': f"Трек '{track.name}' от {track.artist} был удален из плейлиста '{playlist.name}'",
-                            'track_service_id': track.service_track_id,
-                            'track_name': track.name,
-                            'artist_name': track.artist,
-                            'playlist_name': playlist.name,
-                            'playlist_id': playlist.id
-                        }
-                        
-                        notification_service.send_all_notifications(playlist.user, notification_data)
-                        logger.info(f"Уведомления отправлены для пользователя {playlist.user.username}")
-                        
-                    except Exception as notification_error:
-                        logger.error(f"Ошибка отправки уведомлений: {str(notification_error)}")
-                    
-                    logger.info(f"Трек {track.name} отмечен как удаленный из плейлиста {playlist.name}")
-                    
-                    # Принудительно сохраняем изменения для каждого трека
-                    try:
-                        db.session.commit()
-                        logger.info(f"Изменения для трека {track.name} успешно сохранены в БД")
-                    except Exception as commit_error:
-                        logger.error(f"Ошибка при сохранении трека {track.name}: {str(commit_error)}")
-                        db.session.rollback()
-                        raise
-                else:
-                    logger.warning(f"Трек с ID {track_id} не найден в плейлисте {playlist.name}")
-        except Exception as e:
-            logger.error(f"Ошибка в _handle_removed_tracks_impl: {str(e)}")
-            db.session.rollback()
-            raise
+    def _handle_new_tracks(self, playlist, new_tracks):
+        """Добавить новые треки и уведомления пакетными INSERT.
+        
+        Возвращает данные для отправки уведомлений после фиксации транзакции.
+        """
+        # Треки, о которых пользователь уже был уведомлен, сохраняем без повторного уведомления
+        new_ids = [track['id'] for track in new_tracks]
+        already_notified = set()
+        for chunk in _chunked(new_ids, BULK_CHUNK_SIZE):
+            already_notified.update(
+                service_track_id for (service_track_id,) in db.session.query(NotificationHistory.track_service_id).filter(
+                    NotificationHistory.user_id == playlist.user_id,
+                    NotificationHistory.playlist_id == playlist.id,
+                    NotificationHistory.notification_type == 'track_added',
+                    NotificationHistory.track_service_id.in_(chunk)
+                )
+            )
+        
+        added_at = datetime.utcnow()
+        track_ids = self._insert_tracks(playlist, new_tracks, added_at)
+        
+        notification_rows = []
+        notifications = []
+        for track_data in new_tracks:
+            # Трек уже записан параллельной проверкой, уведомление создаст она
+            if track_data['id'] not in track_ids:
+                continue
+            if track_data['id'] in already_notified:
+                logger.info(f"Уведомление для трека {track_data['name']} уже было отправлено, пропускаем")
+                continue
+            
+            message = f"Новый трек '{track_data['name']}' от {track_data['artist']} добавлен в плейлист '{playlist.name}'"
+            notification_rows.append({
+                'user_id': playlist.user_id,
+                'playlist_id': playlist.id,
+                'track_id': track_ids[track_data['id']],
+                'message': message,
+                'is_read': False,
+                'created_at': added_at
+            })
+            notifications.append({
+                'type': 'track_added',
+                'message': message,
+                'track_service_id': track_data['id'],
+                'track_name': track_data['name'],
+                'artist_name': track_data['artist'],
+                'playlist_name': playlist.name,
+                'playlist_id': playlist.id
+            })
+        
+        if notification_rows:
+            db.session.execute(insert(Notification), notification_rows)
+        logger.info(f"Добавлено {len(track_ids)} новых треков в плейлист {playlist.name}")
+        return notifications
     
-    def _handle_new_tracks(self, playlist, current_tracks, new_track_ids):
-        """Обработать новые треки"""
-        if self.app:
-            with self.app.app_context():
-                self._handle_new_tracks_impl(playlist, current_tracks, new_track_ids)
-        else:
-            self._handle_new_tracks_impl(playlist, current_tracks, new_track_ids)
+    def _update_track_counters(self, playlist, added=0, removed=0):
+        """Обновить счетчики треков плейлиста в текущей транзакции.
+        
+        Приращение считается в SQL, чтобы параллельные проверки одного
+        плейлиста не затирали изменения друг друга.
+        """
+        if not added and not removed:
+            return
+        db.session.execute(update(Playlist).where(Playlist.id == playlist.id).values(
+            total_tracks=Playlist.total_tracks + added,
+            active_tracks=Playlist.active_tracks + added - removed,
+            removed_tracks=Playlist.removed_tracks + removed
+        ), execution_options={'synchronize_session': False})
     
-    def _handle_new_tracks_impl(self, playlist, current_tracks, new_track_ids):
-        """Внутренняя реализация обработки новых треков"""
-        try:
-            for track_data in current_tracks:
-                if track_data['id'] in new_track_ids:
-                    # Проверяем, не существует ли уже трек с таким service_track_id
-                    # (может быть добавлен при создании плейлиста или в другой транзакции)
-                    existing_track = Track.query.filter_by(
-                        playlist_id=playlist.id,
-                        service_track_id=track_data['id'],
-                        is_removed=False
-                    ).first()
-                    
-                    if existing_track:
-                        logger.info(f"Трек {track_data['name']} уже существует в плейлисте {playlist.name}, пропускаем")
-                        continue
-                    
-                    # Проверяем, не было ли уже отправлено уведомление для этого трека
-                    from services.notification_service import notification_service
-                    if notification_service.check_notification_already_sent(
-                        playlist.user_id, 
-                        playlist.id, 
-                        track_data['id'], 
-                        'track_added'
-                    ):
-                        logger.info(f"Уведомление для трека {track_data['name']} уже было отправлено, пропускаем")
-                        continue
-                    
-                    track = Track(
-                        playlist_id=playlist.id,
-                        service_track_id=track_data['id'],
-                        name=track_data['name'],
-                        artist=track_data['artist'],
-                        album=track_data.get('album', ''),
-                        duration=track_data.get('duration', 0),
-                        added_at=datetime.utcnow()
-                    )
-                    db.session.add(track)
-                    db.session.flush()  # Получаем ID трека
-                    
-                    # Создаем уведомление в базе данных
-                    notification = Notification(
-                        user_id=playlist.user_id,
-                        playlist_id=playlist.id,
-                        track_id=track.id,
-                        message=f"Новый трек '{track.name}' от {track.artist} добавлен в плейлист '{playlist.name}'"
-                    )
-                    db.session.add(notification)
-                    
-                    # Отправляем уведомления по всем каналам
-                    try:
-                        notification_data = {
-                            'type': 'track_added',
-                            'message': f"Новый трек '{track.name}' от {track.artist} добавлен в плейлист '{playlist.name}'",
-                            'track_service_id': track.service_track_id,
-                            'track_name': track.name,
-                            'artist_name': track.artist,
-                            'playlist_name': playlist.name,
-                            'playlist_id': playlist.id
-                        }
-                        
-                        notification_service.send_all_notifications(playlist.user, notification_data)
-                        logger.info(f"Уведомления о новом треке отправлены для пользователя {playlist.user.username}")
-                        
-                    except Exception as notification_error:
-                        logger.error(f"Ошибка отправки уведомлений о новом треке: {str(notification_error)}")
-                    
-                    logger.info(f"Добавлен новый трек {track.name} в плейлист {playlist.name}")
-                    
-                    # Принудительно сохраняем изменения для каждого трека
-                    try:
-                        db.session.commit()
-                        logger.info(f"Новый трек {track.name} успешно сохранен в БД")
-                    except Exception as commit_error:
-                        logger.error(f"Ошибка при сохранении нового трека {track.name}: {str(commit_error)}")
-                        db.session.rollback()
-                        raise
-        except Exception as e:
-            logger.error(f"Ошибка в _handle_new_tracks_impl: {str(e)}")
-            db.session.rollback()
-            raise
+    def _enqueue_notifications(self, playlist, notifications):
+        """Поставить уведомления в очередь отправки в текущей транзакции"""
+        now = datetime.utcnow()
+        rows = [{
+            'user_id': playlist.user_id,
+            'playlist_id': playlist.id,
+            'payload': json.dumps(notification_data, ensure_ascii=False),
+            'status': 'pending',
+            'attempts': 0,
+            'next_attempt_at': now,
+            'created_at': now
+        } for notification_data in notifications]
+        
+        for chunk in _chunked(rows, BULK_CHUNK_SIZE):
+            db.session.execute(insert(NotificationOutbox), chunk)
+        logger.info(f"В очередь отправки поставлено {len(rows)} уведомлений для пользователя {playlist.user_id}")
+    
+    def _record_version(self, playlist, current_ids, now, added_ids=(), removed_ids=()):
+        """Записать версию состава плейлиста в текущей транзакции.
+        
+        current_ids - ID всех треков плейлиста после изменений. Обычно
+        сохраняются только добавленные и удаленные ID; полный список
+        (контрольная точка) пишется для первой версии и затем раз в
+        checkpoint_interval версий, чтобы восстановление состава не
+        проигрывало длинную цепочку изменений.
+        """
+        latest = db.session.query(
+            PlaylistVersion.version, PlaylistVersion.checkpoint_version
+        ).filter_by(playlist_id=playlist.id).order_by(PlaylistVersion.version.desc()).first()
+        
+        version = latest.version + 1 if latest else 1
+        is_checkpoint = latest is None or version - latest.checkpoint_version >= self.checkpoint_interval
+        if is_checkpoint:
+            added_ids, removed_ids = list(current_ids), []
+        
+        db.session.add(PlaylistVersion(
+            playlist_id=playlist.id,
+            version=version,
+            checkpoint_version=version if is_checkpoint else latest.checkpoint_version,
+            is_checkpoint=is_checkpoint,
+            added_ids=json.dumps(list(added_ids)),
+            removed_ids=json.dumps(list(removed_ids)),
+            track_count=len(current_ids),
+            created_at=now
+        ))
+    
+    def get_playlist_membership(self, playlist, at=None):
+        """Восстановить состав плейлиста на момент at (UTC, по умолчанию - сейчас).
+        
+        Берется последняя контрольная точка не позже at, и к ней по порядку
+        применяются изменения, записанные после нее до at. Возвращает словарь
+        с номером версии, ее временем и треками (ID и данные из каталога)
+        или None, если на этот момент истории плейлиста еще нет.
+        """
+        at = at or datetime.utcnow()
+        checkpoint = PlaylistVersion.query.filter(
+            PlaylistVersion.playlist_id == playlist.id,
+            PlaylistVersion.is_checkpoint == True,
+            PlaylistVersion.created_at <= at
+        ).order_by(PlaylistVersion.created_at.desc()).first()
+        if checkpoint is None:
+            return None
+        
+        # Словарь как упорядоченное множество: порядок треков контрольной
+        # точки сохраняется, новые треки идут в порядке добавления
+        track_ids = dict.fromkeys(json.loads(checkpoint.added_ids))
+        latest = checkpoint
+        for delta in PlaylistVersion.query.filter(
+            PlaylistVersion.playlist_id == playlist.id,
+            PlaylistVersion.created_at >= checkpoint.created_at,
+            PlaylistVersion.created_at <= at,
+            PlaylistVersion.version > checkpoint.version
+        ).order_by(PlaylistVersion.version):
+            for track_id in json.loads(delta.removed_ids):
+                track_ids.pop(track_id, None)
+            track_ids.update(dict.fromkeys(json.loads(delta.added_ids)))
+            latest = delta
+        
+        catalog = self._load_catalog_tracks(playlist.service, track_ids)
+        tracks = []
+        for track_id in track_ids:
+            row = catalog.get(track_id)
+            tracks.append({
+                'id': track_id,
+                'name': row.name if row else None,
+                'artist': row.artist if row else None
+            })
+        
+        return {
+            'version': latest.version,
+            'created_at': latest.created_at,
+            'tracks': tracks
+        }
+    
+    def _initial_next_check(self):
+        """Время первой проверки только что добавленного плейлиста"""
+        hours = self.schedule_config['default_interval_hours'] * random.uniform(0.9, 1.1)
+        return datetime.utcnow() + timedelta(hours=hours)
     
     def add_playlist(self, user, service, playlist_url):
         """Добавить новый плейлист для мониторинга"""
@@ -515,10 +1188,14 @@ class PlaylistMonitor:
             raise ValueError(f"Неподдерживаемый сервис: {service}")
         
         # Для публичных плейлистов Яндекс.Музыки и Deezer не нужен токен
-        if service == 'deezer':
+        if service == 'deezer' or (service == 'yandex_music' and 'music.yandex.ru/playlists/' in playlist_url):
             try:
-                # Получаем информацию о плейлисте Deezer через RapidAPI
-                playlist_info = service_obj.get_public_playlist_info(playlist_url)
+                # Информацию о плейлисте и его треки получаем одним запросом.
+                # При потоковом разборе информация о плейлисте известна только
+                # после чтения всех треков
+                result = service_obj.get_public_playlist(playlist_url)
+                tracks_data = list(result['tracks'])
+                playlist_info = result['info']
                 
                 # Проверяем, не добавлен ли уже этот плейлист
                 existing_playlist = Playlist.query.filter_by(
@@ -530,88 +1207,42 @@ class PlaylistMonitor:
                 if existing_playlist:
                     raise ValueError("Этот плейлист уже добавлен для мониторинга")
                 
-                # Создаем плейлист в базе данных
+                # Создаем плейлист в базе данных. Валидаторы ответа сохраняем,
+                # чтобы первая проверка уже была условным запросом
+                state = result.get('state') or {}
                 playlist = Playlist(
                     user_id=user.id,
                     service=service,
                     service_playlist_id=playlist_info['id'],
                     name=playlist_info['name'],
                     description=playlist_info.get('description', ''),
-                    last_checked=datetime.utcnow()
+                    last_checked=datetime.utcnow(),
+                    next_check_at=self._initial_next_check(),
+                    etag=state.get('etag'),
+                    last_modified=state.get('last_modified'),
+                    content_hash=state.get('content_hash')
                 )
                 db.session.add(playlist)
                 db.session.flush()  # Получаем ID плейлиста
                 
-                # Получаем и сохраняем треки плейлиста Deezer
-                tracks_data = service_obj.get_public_playlist_tracks(playlist_url)
-                for track_data in tracks_data:
-                    track = Track(
-                        playlist_id=playlist.id,
-                        service_track_id=track_data['id'],
-                        name=track_data['name'],
-                        artist=track_data['artist'],
-                        album=track_data.get('album', ''),
-                        duration=track_data.get('duration', 0),
-                        added_at=datetime.utcnow()
-                    )
-                    db.session.add(track)
+                # Сохраняем треки плейлиста
+                self._insert_tracks(playlist, tracks_data, datetime.utcnow())
+                self._record_version(playlist, list(dict.fromkeys(track['id'] for track in tracks_data)),
+                                     playlist.last_checked)
                 
                 db.session.commit()
-                logger.info(f"Плейлист Deezer {playlist.name} добавлен для пользователя {user.username}")
-                
-                return playlist
-                
-            except Exception as e:
-                logger.error(f"Ошибка при добавлении плейлиста Deezer: {str(e)}")
-                raise
-        elif service == 'yandex_music' and 'music.yandex.ru/playlists/' in playlist_url:
-            try:
-                # Получаем информацию о публичном плейлисте
-                playlist_info = service_obj.get_public_playlist_info(playlist_url)
-                
-                # Проверяем, не добавлен ли уже этот плейлист
-                existing_playlist = Playlist.query.filter_by(
-                    user_id=user.id,
-                    service=service,
-                    service_playlist_id=playlist_info['id']
-                ).first()
-                
-                if existing_playlist:
-                    raise ValueError("Этот плейлист уже добавлен для мониторинга")
-                
-                # Создаем плейлист в базе данных
-                playlist = Playlist(
-                    user_id=user.id,
-                    service=service,
-                    service_playlist_id=playlist_info['id'],
-                    name=playlist_info['name'],
-                    description=playlist_info.get('description', ''),
-                    last_checked=datetime.utcnow()
-                )
-                db.session.add(playlist)
-                db.session.flush()  # Получаем ID плейлиста
-                
-                # Получаем и сохраняем треки публичного плейлиста
-                tracks_data = service_obj.get_public_playlist_tracks(playlist_url)
-                for track_data in tracks_data:
-                    track = Track(
-                        playlist_id=playlist.id,
-                        service_track_id=track_data['id'],
-                        name=track_data['name'],
-                        artist=track_data['artist'],
-                        album=track_data.get('album', ''),
-                        duration=track_data.get('duration', 0),
-                        added_at=datetime.utcnow()
-                    )
-                    db.session.add(track)
-                
-                db.session.commit()
-                logger.info(f"Публичный плейлист {playlist.name} добавлен для пользователя {user.username}")
+                if service == 'deezer':
+                    logger.info(f"Плейлист Deezer {playlist.name} добавлен для пользователя {user.username}")
+                else:
+                    logger.info(f"Публичный плейлист {playlist.name} добавлен для пользователя {user.username}")
                 
                 return playlist
                 
             except Exception as e:
-                logger.error(f"Ошибка при добавлении публичного плейлиста: {str(e)}")
+                if service == 'deezer':
+                    logger.error(f"Ошибка при добавлении плейлиста Deezer: {str(e)}")
+                else:
+                    logger.error(f"Ошибка при добавлении публичного плейлиста: {str(e)}")
                 raise
         else:
             # Получаем токен доступа
@@ -649,7 +1280,9 @@ class PlaylistMonitor:
                 service_playlist_id=playlist_info['id'],
                 name=playlist_info['name'],
                 description=playlist_info.get('description', ''),
-                last_checked=datetime.utcnow()
+                last_checked=datetime.utcnow(),
+                next_check_at=self._initial_next_check(),
+                snapshot_id=playlist_info.get('snapshot_id')
             )
             db.session.add(playlist)
             db.session.flush()  # Получаем ID плейлиста
@@ -659,17 +1292,9 @@ class PlaylistMonitor:
                 tracks_data = service_obj.get_playlist_tracks(access_token, playlist_info['id'], refresh_token)
             else:
                 tracks_data = service_obj.get_playlist_tracks(access_token, playlist_info['id'])
-            for track_data in tracks_data:
-                track = Track(
-                    playlist_id=playlist.id,
-                    service_track_id=track_data['id'],
-                    name=track_data['name'],
-                    artist=track_data['artist'],
-                    album=track_data.get('album', ''),
-                    duration=track_data.get('duration', 0),
-                    added_at=datetime.utcnow()
-                )
-                db.session.add(track)
+            self._insert_tracks(playlist, tracks_data, datetime.utcnow())
+            self._record_version(playlist, list(dict.fromkeys(track['id'] for track in tracks_data)),
+                                 playlist.last_checked)
             
             db.session.commit()
             logger.info(f"Плейлист {playlist.name} добавлен для пользователя {user.username}")
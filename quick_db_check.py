@@ -72,7 +72,9 @@ def check_db_quick():
         print(f"   - Удаленных: {removed_tracks}")
         
         if tracks_count > 0:
-            cursor.execute("SELECT name, artist, added_at, is_removed FROM track ORDER BY added_at DESC LIMIT 5")
+            cursor.execute("SELECT catalog_track.name, catalog_track.artist, track.added_at, track.is_removed "
+                           "FROM track JOIN catalog_track ON catalog_track.id = track.catalog_track_id "
+                           "ORDER BY track.added_at DESC LIMIT 5")
             tracks = cursor.fetchall()
             print("   Последние треки:")
             for track in tracks:
@@ -1,6 +1,8 @@
-import requests
+from services.http_client import http_client
+import itertools
 import os
 import jwt
+import threading
 import time
 from datetime import datetime, timedelta
 import json
@@ -12,9 +14,43 @@ class AppleMusicService:
         self.key_id = key_id or os.environ.get('APPLE_MUSIC_KEY_ID')
         self.private_key = private_key or os.environ.get('APPLE_MUSIC_PRIVATE_KEY')
         self.base_url = "https://api.music.apple.com"
+        self.http = http_client.session('apple_music')
+        
+        # Developer token подписывается ES256 и действителен долго, поэтому
+        # кэшируем его и переподписываем незадолго до истечения
+        self.developer_token_ttl = int(os.environ.get('APPLE_MUSIC_TOKEN_TTL', 3600))
+        self.developer_token_refresh_margin = min(300, self.developer_token_ttl // 4)
+        self._developer_token = None
+        self._developer_token_expires_at = 0
+        self._developer_token_lock = threading.Lock()
     
     def get_developer_token(self):
-        """Получить developer token для Apple Music API"""
+        """Получить developer token для Apple Music API.
+        
+        Возвращает закэшированный токен; новый подписывается только когда
+        до истечения старого остается меньше developer_token_refresh_margin.
+        Блокировка не дает параллельным потокам подписывать токен одновременно.
+        """
+        if self._developer_token_is_fresh():
+            return self._developer_token
+        
+        with self._developer_token_lock:
+            # Пока ждали блокировку, токен мог обновить другой поток
+            if self._developer_token_is_fresh():
+                return self._developer_token
+            
+            now = int(time.time())
+            self._developer_token = self._sign_developer_token(now)
+            self._developer_token_expires_at = now + self.developer_token_ttl
+            return self._developer_token
+    
+    def _developer_token_is_fresh(self):
+        """Действует ли закэшированный developer token с запасом по времени"""
+        return (self._developer_token is not None and
+                time.time() < self._developer_token_expires_at - self.developer_token_refresh_margin)
+    
+    def _sign_developer_token(self, issued_at):
+        """Подписать новый developer token"""
         if not all([self.team_id, self.key_id, self.private_key]):
             raise Exception(gettext('service.apple_music.credentials_not_configured'))
         
@@ -26,8 +62,8 @@ class AppleMusicService:
         
         payload = {
             'iss': self.team_id,
-            'iat': int(time.time()),
-            'exp': int(time.time()) + 3600  # Токен действителен 1 час
+            'iat': issued_at,
+            'exp': issued_at + self.developer_token_ttl
         }
         
         try:
@@ -50,7 +86,7 @@ class AppleMusicService:
         
         url = f"{self.base_url}/v1/catalog/us/playlists/{playlist_id}"
         
-        response = requests.get(url, headers=headers)
+        response = self.http.get(url, headers=headers)
         if response.status_code == 200:
             data = response.json()
             playlist = data['data'][0]
@@ -66,49 +102,60 @@ class AppleMusicService:
             raise Exception(gettext('service.apple_music.playlist_info_error', status_code=response.status_code))
     
     def get_playlist_tracks(self, user_token, playlist_id):
-        """Получить треки плейлиста"""
+        """Получить треки плейлиста списком"""
+        return list(self.iter_playlist_tracks(user_token, playlist_id))
+    
+    def iter_playlist_tracks(self, user_token, playlist_id):
+        """Итератор по трекам плейлиста.
+        
+        Первая страница сообщает общее количество треков, после чего остальные
+        страницы загружаются параллельно по мере чтения и отдаются в исходном
+        порядке.
+        """
         developer_token = self.get_developer_token()
         headers = {
             'Authorization': f'Bearer {developer_token}',
             'Music-User-Token': user_token
         }
         
-        tracks = []
         url = f"{self.base_url}/v1/catalog/us/playlists/{playlist_id}/tracks"
         limit = 100
-        offset = 0
         
-        while True:
+        def fetch_page(offset):
             params = {
                 'limit': limit,
                 'offset': offset
             }
             
-            response = requests.get(url, headers=headers, params=params)
+            response = self.http.get(url, headers=headers, params=params)
             if response.status_code != 200:
+                raise Exception(gettext('service.apple_music.playlist_tracks_error', error=f"Status code: {response.status_code}"))
+            return response.json()
+        
+        first_page = fetch_page(0)
+        total = first_page.get('meta', {}).get('total', 0)
+        pages = itertools.chain([first_page], http_client.iter_pages(fetch_page, range(limit, total, limit)))
+        return self._parse_pages(pages)
+    
+    def _parse_pages(self, pages):
+        """Разобрать треки из страниц ответа по мере их загрузки"""
+        for page in pages:
+            # Неудачная страница прерывает загрузку исключением в fetch_page,
+            # список заканчивается на первой пустой странице
+            if not page.get('data'):
                 break
             
-            data = response.json()
-            if not data.get('data'):
-                break
-            
-            for track_data in data['data']:
+            for track_data in page['data']:
                 if track_data['type'] == 'songs':
                     track = track_data['attributes']
-                    tracks.append({
+                    yield {
                         'id': track_data['id'],
                         'name': track['name'],
                         'artist': track['artistName'],
                         'album': track['albumName'],
                         'duration': int(track['durationInMillis'] / 1000),  # Конвертируем в секунды
                         'added_at': datetime.utcnow().isoformat()  # Apple Music не предоставляет время добавления
-                    })
-            
-            offset += limit
-            if offset >= data.get('meta', {}).get('total', 0):
-                break
-        
-        return tracks
+                    }
     
     def _extract_playlist_id(self, url):
         """Извлечь ID плейлиста из URL"""
@@ -138,7 +185,7 @@ class AppleMusicService:
             }
             
             url = f"{self.base_url}/v1/me"
-            response = requests.get(url, headers=headers)
+            response = self.http.get(url, headers=headers)
             return response.status_code == 200
         except:
             return False
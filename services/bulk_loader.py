@@ -0,0 +1,123 @@
+"""
+Пакетная вставка строк с пропуском конфликтов по уникальному индексу.
+
+На Postgres большие пачки загружаются через COPY во временную таблицу и
+переносятся в целевую одним INSERT ... SELECT ... ON CONFLICT DO NOTHING:
+COPY передает строки потоком без разбора отдельного INSERT на каждую.
+Небольшие пачки и SQLite идут через INSERT ... ON CONFLICT DO NOTHING с
+executemany крупными пачками (с RETURNING SQLAlchemy сама склеивает строки
+в многострочные VALUES). Вставка выполняется в текущей транзакции сессии.
+"""
+
+import io
+import itertools
+import logging
+import os
+from datetime import date, datetime
+
+from sqlalchemy import column, insert, select, table as sql_table
+from sqlalchemy.dialects import postgresql, sqlite
+
+logger = logging.getLogger(__name__)
+
+
+class BulkLoader:
+    """Вставка строк с учетом диалекта базы данных"""
+    
+    def __init__(self, batch_size=None, copy_min_rows=None):
+        # Строк в одном executemany
+        self.batch_size = max(1, int(batch_size or os.environ.get('BULK_LOAD_BATCH_SIZE', 5000)))
+        # С какого числа строк на Postgres выгоднее COPY, чем INSERT:
+        # временная таблица стоит нескольких лишних запросов
+        self.copy_min_rows = int(copy_min_rows or os.environ.get('BULK_COPY_MIN_ROWS', 1000))
+        self._stage_ids = itertools.count(1)
+    
+    def insert(self, session, table, rows, conflict_columns=None, conflict_where=None, returning=()):
+        """Вставить строки, пропуская те, что конфликтуют с уже существующими.
+        
+        conflict_columns и conflict_where задают уникальный (возможно,
+        частичный) индекс конфликта; без них пропускается конфликт по любому
+        ограничению. returning - столбцы, которые нужно вернуть для
+        действительно вставленных строк. Возвращает список этих строк (пустой,
+        если returning не задан). Все строки должны иметь одинаковый набор
+        ключей. На других СУБД конфликты не пропускаются.
+        """
+        if not rows:
+            return []
+        
+        dialect = session.get_bind().dialect.name
+        if dialect == 'postgresql' and len(rows) >= self.copy_min_rows:
+            return self._copy_insert(session, table, rows, conflict_columns, conflict_where, returning)
+        
+        statement = self._insert_statement(dialect, table, conflict_columns, conflict_where)
+        if returning:
+            statement = statement.returning(*returning)
+        
+        inserted = []
+        for start in range(0, len(rows), self.batch_size):
+            result = session.execute(statement, rows[start:start + self.batch_size])
+            if returning:
+                inserted.extend(result.all())
+        return inserted
+    
+    def _insert_statement(self, dialect, table, conflict_columns=None, conflict_where=None):
+        """INSERT, пропускающий строки с конфликтом по уникальному индексу"""
+        if dialect == 'postgresql':
+            statement = postgresql.insert(table)
+        elif dialect == 'sqlite':
+            statement = sqlite.insert(table)
+        else:
+            return insert(table)
+        return statement.on_conflict_do_nothing(index_elements=conflict_columns, index_where=conflict_where)
+    
+    def _copy_insert(self, session, table, rows, conflict_columns, conflict_where, returning):
+        """Загрузить строки через COPY во временную таблицу и перенести их в целевую.
+        
+        Временная таблица повторяет нужные столбцы целевой и удаляется сразу
+        после переноса, поэтому несколько загрузок в одной транзакции не
+        мешают друг другу.
+        """
+        columns = list(rows[0].keys())
+        stage_name = f"bulk_{table.name}_{next(self._stage_ids)}"
+        column_list = ', '.join(columns)
+        connection = session.connection()
+        
+        connection.exec_driver_sql(
+            f"CREATE TEMP TABLE {stage_name} AS SELECT {column_list} FROM {table.name} WITH NO DATA"
+        )
+        
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write('\t'.join(_copy_value(row[name]) for name in columns))
+            buffer.write('\n')
+        buffer.seek(0)
+        with connection.connection.cursor() as cursor:
+            cursor.copy_expert(f"COPY {stage_name} ({column_list}) FROM STDIN", buffer)
+        
+        stage = sql_table(stage_name, *[column(name) for name in columns])
+        statement = postgresql.insert(table).from_select(columns, select(*stage.columns))
+        statement = statement.on_conflict_do_nothing(index_elements=conflict_columns, index_where=conflict_where)
+        if returning:
+            statement = statement.returning(*returning)
+        result = connection.execute(statement)
+        inserted = result.all() if returning else []
+        
+        connection.exec_driver_sql(f"DROP TABLE {stage_name}")
+        logger.debug(f"COPY: загружено {len(rows)} строк в {table.name}, вставлено {len(inserted) if returning else result.rowcount}")
+        return inserted
+
+
+def _copy_value(value):
+    """Значение в текстовом формате COPY: NULL - \\N, спецсимволы экранируются"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+# Глобальный загрузчик, общий для монитора и обслуживающих скриптов
+bulk_loader = BulkLoader()
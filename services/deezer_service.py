@@ -1,10 +1,19 @@
-import requests
+from services.http_client import http_client
+import itertools
 import os
 from datetime import datetime, timedelta
 import json
 import re
 from flask_babel import gettext
 
+
+def _request_credential(request_kwargs):
+    """Лимит запросов Deezer считается по токену пользователя или ключу RapidAPI"""
+    params = request_kwargs.get('params') or {}
+    headers = request_kwargs.get('headers') or {}
+    return params.get('access_token') or headers.get('x-rapidapi-key')
+
+
 class DeezerService:
     def __init__(self, app_id=None, app_secret=None, redirect_uri=None):
         self.app_id = app_id or os.environ.get('DEEZER_APP_ID')
@@ -13,6 +22,7 @@ class DeezerService:
         self.base_url = "https://api.deezer.com"
         self.rapidapi_key = os.environ.get('RAPIDAPI_KEY')
         self.rapidapi_host = "deezerdevs-deezer.p.rapidapi.com"
+        self.http = http_client.session('deezer', credential=_request_credential)
     
     def get_auth_url(self):
         """Получить URL для авторизации"""
@@ -32,7 +42,7 @@ class DeezerService:
             'code': code
         }
         
-        response = requests.get(url, params=params)
+        response = self.http.get(url, params=params)
         if response.status_code == 200:
             # Deezer возвращает токен в формате "access_token=TOKEN&expires=SECONDS"
             token_data = response.text
@@ -56,7 +66,7 @@ class DeezerService:
         url = f"{self.base_url}/playlist/{playlist_id}"
         params = {'access_token': access_token}
         
-        response = requests.get(url, params=params)
+        response = self.http.get(url, params=params)
         if response.status_code == 200:
             data = response.json()
             return {
@@ -71,38 +81,51 @@ class DeezerService:
             raise Exception(gettext('service.deezer.playlist_info_error', status_code=response.status_code))
     
     def get_playlist_tracks(self, access_token, playlist_id):
-        """Получить треки плейлиста"""
-        tracks = []
+        """Получить треки плейлиста списком"""
+        return list(self.iter_playlist_tracks(access_token, playlist_id))
+    
+    def iter_playlist_tracks(self, access_token, playlist_id):
+        """Итератор по трекам плейлиста.
+        
+        Первая страница сообщает общее количество треков, после чего остальные
+        страницы загружаются параллельно по мере чтения и отдаются в исходном
+        порядке.
+        """
         url = f"{self.base_url}/playlist/{playlist_id}/tracks"
-        params = {'access_token': access_token, 'limit': 100}
-        index = 0
+        limit = 100
         
-        while True:
-            params['index'] = index
-            response = requests.get(url, params=params)
+        def fetch_page(index):
+            params = {'access_token': access_token, 'limit': limit, 'index': index}
+            response = self.http.get(url, params=params)
             
             if response.status_code != 200:
+                raise Exception(gettext('service.deezer.playlist_tracks_error', error=f"Status code: {response.status_code}"))
+            return response.json()
+        
+        first_page = fetch_page(0)
+        pages = itertools.chain([first_page], http_client.iter_pages(
+            fetch_page, range(limit, first_page.get('total', 0), limit)))
+        return self._parse_pages(pages)
+    
+    def _parse_pages(self, pages):
+        """Разобрать треки из страниц ответа по мере их загрузки"""
+        for page in pages:
+            # Ошибку API Deezer возвращает с кодом 200. Неполный список нельзя
+            # сравнивать с сохраненными треками, поэтому загрузка прерывается
+            if page.get('error'):
+                raise Exception(gettext('service.deezer.playlist_tracks_error', error=page['error'].get('message', '')))
+            if not page.get('data'):
                 break
             
-            data = response.json()
-            if not data.get('data'):
-                break
-            
-            for track_data in data['data']:
-                tracks.append({
+            for track_data in page['data']:
+                yield {
                     'id': str(track_data['id']),
                     'name': track_data['title'],
                     'artist': track_data['artist']['name'],
                     'album': track_data['album']['title'],
                     'duration': track_data['duration'],
                     'added_at': datetime.utcnow().isoformat()  # Deezer не предоставляет время добавления
-                })
-            
-            index += 100
-            if index >= data.get('total', 0):
-                break
-        
-        return tracks
+                }
     
     def _extract_playlist_id(self, url):
         """Извлечь ID плейлиста из URL"""
@@ -140,99 +163,148 @@ class DeezerService:
             url = f"https://{self.rapidapi_host}/playlist/{playlist_id}"
             headers = self._get_rapidapi_headers()
             
-            response = requests.get(url, headers=headers)
+            response = self.http.get(url, headers=headers)
             
             if response.status_code == 200:
-                data = response.json()
-                return {
-                    'id': str(data['id']),
-                    'name': data['title'],
-                    'description': data.get('description', ''),
-                    'tracks_count': data.get('nb_tracks', 0),
-                    'owner': data.get('creator', {}).get('name', 'Unknown'),
-                    'public': data.get('public', True)
-                }
+                return self._public_playlist_info(response.json())
             else:
                 raise Exception(gettext('service.deezer.playlist_info_error', status_code=response.status_code))
         except Exception as e:
             raise Exception(gettext('service.deezer.playlist_info_error', status_code=str(e)))
     
+    def _public_playlist_info(self, data):
+        """Разобрать информацию о плейлисте из ответа RapidAPI"""
+        return {
+            'id': str(data['id']),
+            'name': data['title'],
+            'description': data.get('description', ''),
+            'tracks_count': data.get('nb_tracks', 0),
+            'owner': data.get('creator', {}).get('name', 'Unknown'),
+            'public': data.get('public', True)
+        }
+    
+    def _public_track(self, track_data):
+        """Разобрать трек из ответа RapidAPI"""
+        return {
+            'id': str(track_data['id']),
+            'name': track_data['title'],
+            'artist': track_data.get('artist', {}).get('name', 'Unknown'),
+            'album': track_data.get('album', {}).get('title', ''),
+            'duration': track_data.get('duration', 0),
+            'added_at': datetime.utcnow().isoformat()
+        }
+    
     def get_public_playlist_tracks(self, playlist_url):
         """Получить треки плейлиста через RapidAPI (без авторизации)"""
+        return list(self.get_public_playlist(playlist_url)['tracks'])
+    
+    def get_public_playlist(self, playlist_url, etag=None, last_modified=None, content_hash=None):
+        """Получить информацию о плейлисте и его треки через RapidAPI.
+        
+        Ресурс /playlist/{id} содержит и информацию о плейлисте, и первую
+        страницу треков, поэтому добавление и проверка обходятся одним
+        запросом к нему. Запрос условный: с валидаторами прошлой проверки.
+        Ответ плейлиста содержит checksum состава треков, поэтому совпадение
+        хэша первой страницы означает, что плейлист не изменился, и остальные
+        страницы не загружаются.
+        
+        Возвращает словарь:
+            info      - информация о плейлисте (None, если не изменился)
+            tracks    - итератор по трекам (None, если не изменился); страницы
+                        после первой загружаются по мере чтения
+            unchanged - True, если плейлист не изменился
+            state     - новые валидаторы для сохранения в Playlist
+        Если какую-то страницу загрузить не удалось, чтение tracks завершается
+        исключением: неполный список нельзя сравнивать с сохраненными треками.
+        """
         playlist_id = self._extract_playlist_id(playlist_url)
         if not playlist_id:
             raise ValueError(gettext('service.deezer.invalid_playlist_url'))
         
         try:
-            tracks = []
             url = f"https://{self.rapidapi_host}/playlist/{playlist_id}"
             headers = self._get_rapidapi_headers()
             
-            response = requests.get(url, headers=headers)
+            response, validators = http_client.conditional_get(
+                self.http, url, etag=etag, last_modified=last_modified,
+                content_hash=content_hash, headers=headers
+            )
+            
+            if response is None:
+                return {'info': None, 'tracks': None, 'unchanged': True, 'state': validators}
             
             if response.status_code == 200:
                 data = response.json()
+                # Ошибки (например, превышение квоты) RapidAPI возвращает с кодом 200
+                if data.get('error'):
+                    raise Exception(data['error'].get('message', ''))
+                info = self._public_playlist_info(data)
                 
                 # Получаем треки из плейлиста
                 tracks_data = data.get('tracks', {}).get('data', [])
+                pages = [tracks_data]
                 
-                for track_data in tracks_data:
-                    # Проверяем, что трек не None (может быть удален)
-                    if track_data:
-                        tracks.append({
-                            'id': str(track_data['id']),
-                            'name': track_data['title'],
-                            'artist': track_data.get('artist', {}).get('name', 'Unknown'),
-                            'album': track_data.get('album', {}).get('title', ''),
-                            'duration': track_data.get('duration', 0),
-                            'added_at': datetime.utcnow().isoformat()
-                        })
-                
-                # Обрабатываем пагинацию, если есть
+                # Обрабатываем пагинацию, если есть: общее количество треков
+                # известно из первого ответа, остальные страницы загружаем
+                # параллельно по мере чтения треков
                 tracks_obj = data.get('tracks', {})
-                next_url = tracks_obj.get('next')
-                index = len(tracks_data)
-                
-                while next_url:
-                    # Для RapidAPI используем параметр index для пагинации
+                total = data.get('nb_tracks') or tracks_obj.get('total', 0)
+                if tracks_obj.get('next') and tracks_data:
                     pagination_url = f"https://{self.rapidapi_host}/playlist/{playlist_id}/tracks"
-                    params = {'index': index, 'limit': 100}
-                    
-                    pagination_response = requests.get(pagination_url, headers=headers, params=params)
+                    limit = 100
                     
-                    if pagination_response.status_code == 200:
-                        pagination_data = pagination_response.json()
-                        pagination_tracks = pagination_data.get('data', [])
+                    def fetch_page(index):
+                        # Для RapidAPI используем параметр index для пагинации
+                        params = {'index': index, 'limit': limit}
+                        pagination_response = self.http.get(pagination_url, headers=headers, params=params)
                         
-                        if not pagination_tracks:
-                            break
-                        
-                        for track_data in pagination_tracks:
-                            if track_data:
-                                tracks.append({
-                                    'id': str(track_data['id']),
-                                    'name': track_data['title'],
-                                    'artist': track_data.get('artist', {}).get('name', 'Unknown'),
-                                    'album': track_data.get('album', {}).get('title', ''),
-                                    'duration': track_data.get('duration', 0),
-                                    'added_at': datetime.utcnow().isoformat()
-                                })
-                        
-                        index += len(pagination_tracks)
-                        next_url = pagination_data.get('next')
-                    else:
-                        break
+                        if pagination_response.status_code != 200:
+                            raise Exception(f"Status code: {pagination_response.status_code}")
+                        page = pagination_response.json()
+                        if page.get('error'):
+                            raise Exception(page['error'].get('message', ''))
+                        return page.get('data', [])
+                    
+                    pages = itertools.chain(pages, http_client.iter_pages(
+                        fetch_page, range(len(tracks_data), total, limit)))
                 
-                return tracks
+                tracks = self._iter_public_tracks(pages, total)
+                return {'info': info, 'tracks': tracks, 'unchanged': False, 'state': validators}
             else:
                 raise Exception(gettext('service.deezer.playlist_tracks_error', error=f"Status code: {response.status_code}"))
         except Exception as e:
             raise Exception(gettext('service.deezer.playlist_tracks_error', error=str(e)))
     
+    def _iter_public_tracks(self, pages, total=0):
+        """Разобрать треки публичного плейлиста по мере загрузки страниц.
+        
+        total - количество треков из ответа плейлиста: пустая страница раньше
+        него означает неполный список, а не его конец.
+        """
+        try:
+            offset = 0
+            for page_tracks in pages:
+                # Список неполный: проверка прерывается, а не сравнивает
+                # обрезанный список с сохраненными треками
+                if page_tracks is None:
+                    raise Exception("Empty page in response")
+                if not page_tracks:
+                    if offset < total:
+                        raise Exception(f"Empty page at index {offset} of {total}")
+                    break
+                offset += len(page_tracks)
+                
+                for track_data in page_tracks:
+                    # Проверяем, что трек не None (может быть удален)
+                    if track_data:
+                        yield self._public_track(track_data)
+        except Exception as e:
+            raise Exception(gettext('service.deezer.playlist_tracks_error', error=str(e)))
+    
     def is_token_valid(self, access_token):
         """Проверить валидность токена"""
         url = f"{self.base_url}/user/me"
         params = {'access_token': access_token}
         
-        response = requests.get(url, params=params)
+        response = self.http.get(url, params=params)
         return response.status_code == 200
@@ -0,0 +1,263 @@
+"""
+Общий HTTP-транспорт для клиентов музыкальных сервисов.
+
+Каждый сервис получает свою requests.Session с пулом соединений: соединения
+с хостом переиспользуются (keep-alive), поэтому запрос очередной страницы
+не платит за новое TCP/TLS-рукопожатие. У всех запросов есть таймауты на
+подключение и чтение, а временные ошибки (обрывы соединения, 5xx)
+повторяются с экспоненциальной задержкой. Частоту запросов ограничивает
+общий rate_limiter; ответ 429 приостанавливает всю корзину сервиса.
+"""
+
+import contextvars
+import hashlib
+import itertools
+import logging
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from services.rate_limiter import rate_limiter
+
+logger = logging.getLogger(__name__)
+
+# Коды ответа, при которых запрос имеет смысл повторить. 429 обрабатывает
+# ограничитель частоты, чтобы паузу соблюдали все потоки, а не только один
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+
+class TimeoutSession(requests.Session):
+    """Сессия с таймаутом по умолчанию и ограничением частоты запросов.
+
+    Перед каждым запросом забирается токен из корзины сервиса (или ключа
+    доступа, который возвращает функция credential). На ответ 429 корзина
+    ставится на паузу по Retry-After, и запрос повторяется.
+    """
+
+    def __init__(self, timeout, service=None, credential=None, limiter=None):
+        super().__init__()
+        self.timeout = timeout
+        self.service = service
+        self.credential = credential
+        self.limiter = limiter or rate_limiter
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+
+        bucket = None
+        if self.service:
+            credential = self.credential(kwargs) if self.credential else None
+            bucket = self.limiter.bucket(self.service, credential)
+        if bucket is None:
+            return super().request(method, url, **kwargs)
+
+        attempt = 0
+        while True:
+            bucket.acquire()
+            response = super().request(method, url, **kwargs)
+            if response.status_code != 429:
+                bucket.record_success()
+                return response
+            if attempt >= self.limiter.max_retries:
+                logger.warning(f"Превышен лимит запросов к {self.service}, попытки исчерпаны")
+                return response
+
+            delay = self.limiter.backoff_delay(attempt, response.headers.get('Retry-After'))
+            bucket.pause(delay)
+            logger.warning(f"Превышен лимит запросов к {self.service} (429), "
+                           f"пауза {delay:.1f} сек., попытка {attempt + 1}")
+            response.close()
+            attempt += 1
+
+
+class HashingReader:
+    """Файловый объект поверх потокового ответа, считающий хэш тела.
+
+    Позволяет разбирать большой ответ по мере чтения из сокета (например,
+    ijson) и одновременно получить тот же content_hash, что и conditional_get
+    для ответа, прочитанного целиком.
+    """
+
+    def __init__(self, response, chunk_size=65536):
+        self._chunks = response.iter_content(chunk_size)
+        self._hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        if size == 0:
+            return b''
+        if size is None or size < 0:
+            data = b''.join(self._chunks)
+        else:
+            # Парсеру достаточно очередного блока любого размера, пустой блок - конец тела
+            data = next(self._chunks, b'')
+        self._hash.update(data)
+        return data
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+class HttpClient:
+    """Реестр HTTP-сессий сервисов с общими настройками пулов, таймаутов и повторов"""
+
+    def __init__(self, connect_timeout=None, read_timeout=None, pool_size=None,
+                 max_retries=None, retry_backoff=None):
+        self.connect_timeout = float(connect_timeout or os.environ.get('HTTP_CONNECT_TIMEOUT', 5))
+        self.read_timeout = float(read_timeout or os.environ.get('HTTP_READ_TIMEOUT', 30))
+        # Размер пула соединений к одному хосту: не меньше лимита параллельных
+        # проверок сервиса, умноженного на PAGE_FETCH_FANOUT, иначе лишние
+        # соединения будут открываться и закрываться на каждый запрос
+        self.pool_size = int(pool_size or os.environ.get('HTTP_POOL_SIZE', 16))
+        self.max_retries = int(max_retries if max_retries is not None else os.environ.get('HTTP_MAX_RETRIES', 3))
+        self.retry_backoff = float(retry_backoff or os.environ.get('HTTP_RETRY_BACKOFF', 0.5))
+        # Сколько страниц одного списка треков загружается одновременно
+        self.page_fanout = max(1, int(os.environ.get('PAGE_FETCH_FANOUT', 4)))
+
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    @property
+    def timeout(self):
+        """Таймаут (подключение, чтение) для requests"""
+        return (self.connect_timeout, self.read_timeout)
+
+    def session(self, name, credential=None):
+        """Получить сессию сервиса (создается при первом обращении).
+
+        credential - функция, которая по аргументам запроса возвращает ключ
+        доступа, если лимит сервиса считается по ключу, а не на приложение.
+        """
+        with self._lock:
+            session = self._sessions.get(name)
+            if session is None:
+                session = self._create_session(name, credential)
+                self._sessions[name] = session
+            return session
+
+    def _create_session(self, name, credential=None):
+        """Создать сессию с пулом соединений и политикой повторов"""
+        retry = Retry(
+            total=self.max_retries,
+            backoff_factor=self.retry_backoff,
+            status_forcelist=RETRY_STATUS_CODES,
+            # Повторяем только идемпотентные запросы
+            allowed_methods=frozenset(['GET', 'HEAD', 'OPTIONS']),
+            # Иначе urllib3 сам повторяет 429 с Retry-After в обход ограничителя
+            respect_retry_after_header=False,
+            # После исчерпания попыток возвращаем последний ответ,
+            # код ответа проверяют сами сервисы
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_size,
+            pool_maxsize=self.pool_size,
+            max_retries=retry
+        )
+
+        session = TimeoutSession(self.timeout, service=name, credential=credential)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def conditional_get(self, session, url, etag=None, last_modified=None, content_hash=None, **kwargs):
+        """Условный GET: отправить сохраненные валидаторы и сравнить хэш тела.
+
+        Возвращает пару (ответ, валидаторы). Ответ равен None, если ресурс не
+        изменился: сервер ответил 304 или тело совпало по хэшу с прошлым.
+        Тогда разбирать ответ не нужно. Валидаторы (etag, last_modified,
+        content_hash) нужно сохранить до следующего запроса. Для ответа с
+        ошибкой валидаторы пустые.
+
+        При stream=True тело не читается: content_hash в валидаторах пустой,
+        его считает вызывающий код (см. HashingReader) и сам сравнивает с
+        прошлым.
+        """
+        headers = dict(kwargs.pop('headers', None) or {})
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+        response = session.get(url, headers=headers, **kwargs)
+        if response.status_code == 304:
+            return None, {
+                'etag': response.headers.get('ETag', etag),
+                'last_modified': response.headers.get('Last-Modified', last_modified),
+                'content_hash': content_hash
+            }
+        if response.status_code != 200:
+            return response, {}
+
+        validators = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'content_hash': None
+        }
+        if kwargs.get('stream'):
+            return response, validators
+
+        validators['content_hash'] = hashlib.sha256(response.content).hexdigest()
+        if content_hash and validators['content_hash'] == content_hash:
+            return None, validators
+        return response, validators
+
+    def fetch_pages(self, fetch_page, offsets, fanout=None):
+        """Загрузить страницы по списку смещений параллельно.
+
+        Результаты возвращаются списком в порядке смещений (см. iter_pages).
+        """
+        return list(self.iter_pages(fetch_page, offsets, fanout))
+
+    def iter_pages(self, fetch_page, offsets, fanout=None):
+        """Загружать страницы по списку смещений параллельно, отдавая их по порядку.
+
+        Одновременно загружается не больше fanout страниц: как только
+        потребитель забирает очередную страницу, запрашивается следующая.
+        Поэтому загрузка идет параллельно с обработкой уже полученных страниц,
+        а в памяти одновременно находится не больше fanout страниц.
+
+        Каждая задача выполняется в копии контекста вызывающего потока,
+        поэтому внутри доступны контекст приложения Flask и переводы
+        сообщений об ошибках. Если загрузка какой-либо страницы завершилась
+        исключением, оно пробрасывается. Если потребитель прекращает чтение,
+        еще не начатые загрузки отменяются.
+        """
+        offsets = iter(offsets)
+        fanout = fanout or self.page_fanout
+        if fanout <= 1:
+            for offset in offsets:
+                yield fetch_page(offset)
+            return
+
+        executor = ThreadPoolExecutor(max_workers=fanout, thread_name_prefix='page-fetch')
+
+        def submit(offset):
+            return executor.submit(contextvars.copy_context().run, fetch_page, offset)
+
+        try:
+            pending = deque(submit(offset) for offset in itertools.islice(offsets, fanout))
+            while pending:
+                page = pending.popleft().result()
+                # Следующую страницу запрашиваем до того, как отдать текущую
+                for offset in itertools.islice(offsets, 1):
+                    pending.append(submit(offset))
+                yield page
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def close(self):
+        """Закрыть все сессии и их соединения"""
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+# Глобальный HTTP-транспорт, общий для всех сервисов
+http_client = HttpClient()
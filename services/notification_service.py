@@ -1,9 +1,11 @@
 import smtplib
 import requests
 import logging
+import json
+import random
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 import os
 
 logger = logging.getLogger(__name__)
@@ -32,6 +34,15 @@ class NotificationService:
             'vapid_private_key': os.environ.get('VAPID_PRIVATE_KEY'),
             'vapid_email': os.environ.get('VAPID_EMAIL')
         }
+        
+        # Настройки диспетчера очереди уведомлений
+        self.outbox_config = {
+            'batch_size': int(os.environ.get('NOTIFICATION_DISPATCH_BATCH', 100)),
+            'max_attempts': int(os.environ.get('NOTIFICATION_MAX_ATTEMPTS', 5)),
+            'retry_base_seconds': int(os.environ.get('NOTIFICATION_RETRY_BASE_SECONDS', 60)),
+            # Сколько секунд уведомление закреплено за диспетчером, взявшим его в работу
+            'claim_timeout_seconds': int(os.environ.get('NOTIFICATION_CLAIM_TIMEOUT_SECONDS', 300))
+        }
     
     def send_email_notification(self, user_email, subject, message,
                                 track_name=None, playlist_name=None):
@@ -416,6 +427,163 @@ PlaylistChecker - Уведомление
         logger.info(f"Уведомления для пользователя {user.username}: {results}")
         return results
 
+    
+    def dispatch_outbox(self, batch_size=None):
+        """Отправить уведомления из очереди, срок отправки которых наступил.
+        
+        Каждое уведомление сначала закрепляется за текущим диспетчером условным
+        UPDATE, поэтому несколько процессов могут разбирать очередь одновременно.
+        Возвращает количество обработанных уведомлений.
+        """
+        from app import NotificationOutbox, db
+        
+        batch_size = batch_size or self.outbox_config['batch_size']
+        now = datetime.utcnow()
+        
+        candidates = db.session.query(NotificationOutbox.id, NotificationOutbox.attempts).filter(
+            NotificationOutbox.status == 'pending',
+            NotificationOutbox.next_attempt_at <= now
+        ).order_by(NotificationOutbox.next_attempt_at).limit(batch_size).all()
+        
+        processed = 0
+        for item_id, attempts in candidates:
+            # Закрепляем уведомление: если его уже взял другой диспетчер, attempts изменится
+            claimed = db.session.query(NotificationOutbox).filter(
+                NotificationOutbox.id == item_id,
+                NotificationOutbox.status == 'pending',
+                NotificationOutbox.attempts == attempts
+            ).update({
+                'attempts': attempts + 1,
+                'next_attempt_at': now + timedelta(seconds=self.outbox_config['claim_timeout_seconds'])
+            }, synchronize_session=False)
+            db.session.commit()
+            if not claimed:
+                continue
+            
+            item = db.session.get(NotificationOutbox, item_id)
+            try:
+                self._deliver_outbox_item(item)
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Ошибка обработки уведомления {item_id} из очереди: {str(e)}")
+                self._schedule_outbox_retry(item, str(e))
+            processed += 1
+        
+        if processed:
+            logger.info(f"Диспетчер уведомлений обработал {processed} уведомлений из очереди")
+        return processed
+    
+    def _outbox_channels(self, user):
+        """Каналы, по которым пользователь должен получить уведомление"""
+        from app import PushSubscription
+        
+        channels = []
+        if user.email and user.email_notifications_enabled and \
+                all([self.email_config['username'], self.email_config['password']]):
+            channels.append('email')
+        if user.telegram_chat_id and user.telegram_notifications_enabled and self.telegram_config['bot_token']:
+            channels.append('telegram')
+        if user.browser_notifications_enabled and \
+                all(self.webpush_config.values()) and \
+                PushSubscription.query.filter_by(user_id=user.id).first():
+            channels.append('browser')
+        return channels
+    
+    def _deliver_outbox_item(self, item):
+        """Отправить одно уведомление из очереди по каналам, которые еще не получили его"""
+        from app import NotificationHistory, User, db
+        from sqlalchemy.exc import IntegrityError
+        
+        notification_data = json.loads(item.payload)
+        user = db.session.get(User, item.user_id)
+        
+        # При первой попытке фиксируем уведомление в истории: уникальный индекс
+        # защищает от повторной отправки одного и того же изменения
+        if item.history_id is None:
+            if self.check_notification_already_sent(item.user_id, item.playlist_id,
+                                                    notification_data.get('track_service_id'),
+                                                    notification_data.get('type')):
+                self._finish_outbox_item(item, 'skipped')
+                return
+            
+            history = NotificationHistory(
+                user_id=item.user_id,
+                playlist_id=item.playlist_id,
+                notification_type=notification_data.get('type', 'track_changed'),
+                track_service_id=notification_data.get('track_service_id'),
+                track_name=notification_data.get('track_name'),
+                artist_name=notification_data.get('artist_name'),
+                playlist_name=notification_data.get('playlist_name'),
+                message=notification_data.get('message', ''),
+                sent_via='sending'  # Временный статус
+            )
+            try:
+                db.session.add(history)
+                db.session.flush()
+            except IntegrityError:
+                db.session.rollback()
+                logger.info(f"Уведомление о треке {notification_data.get('track_service_id')} уже обрабатывается или отправлено")
+                self._finish_outbox_item(item, 'skipped')
+                return
+            item.history_id = history.id
+            db.session.commit()
+        
+        channel_status = json.loads(item.channel_status) if item.channel_status else {}
+        title = f"Изменение в плейлисте {notification_data.get('playlist_name', '')}"
+        message = notification_data.get('message', '')
+        track_name = notification_data.get('track_name')
+        playlist_name = notification_data.get('playlist_name')
+        
+        for channel in self._outbox_channels(user):
+            if channel_status.get(channel) == 'sent':
+                continue
+            
+            if channel == 'email':
+                sent = self.send_email_notification(user.email, title, message, track_name, playlist_name)
+            elif channel == 'telegram':
+                sent = self.send_telegram_notification(user.telegram_chat_id, message, track_name, playlist_name)
+            else:
+                sent = self.send_browser_notification(user.id, title, message, track_name, playlist_name)
+            channel_status[channel] = 'sent' if sent else 'failed'
+        
+        item.channel_status = json.dumps(channel_status)
+        failed_channels = [channel for channel, status in channel_status.items() if status == 'failed']
+        if failed_channels:
+            self._schedule_outbox_retry(item, f"Не удалось отправить: {', '.join(failed_channels)}")
+        else:
+            self._finish_outbox_item(item, 'sent')
+    
+    def _finish_outbox_item(self, item, status):
+        """Завершить обработку уведомления и записать каналы отправки в историю"""
+        from app import NotificationHistory, db
+        
+        item.status = status
+        item.sent_at = datetime.utcnow()
+        
+        if item.history_id:
+            channel_status = json.loads(item.channel_status) if item.channel_status else {}
+            sent_channels = [channel for channel, result in channel_status.items() if result == 'sent']
+            history = db.session.get(NotificationHistory, item.history_id)
+            if history:
+                history.sent_via = ', '.join(sent_channels) if sent_channels else 'none'
+        
+        db.session.commit()
+    
+    def _schedule_outbox_retry(self, item, error):
+        """Запланировать повторную отправку с экспоненциальной задержкой"""
+        from app import db
+        
+        item.last_error = error
+        if item.attempts >= self.outbox_config['max_attempts']:
+            logger.error(f"Уведомление {item.id} не отправлено после {item.attempts} попыток: {error}")
+            self._finish_outbox_item(item, 'failed')
+            return
+        
+        delay = self.outbox_config['retry_base_seconds'] * (2 ** (item.attempts - 1))
+        item.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay * random.uniform(0.8, 1.2))
+        db.session.commit()
+        logger.info(f"Повторная отправка уведомления {item.id} запланирована через {int(delay)} сек.")
+
 
 # Глобальный экземпляр сервиса уведомлений
 notification_service = NotificationService()
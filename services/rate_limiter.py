@@ -0,0 +1,192 @@
+"""
+Ограничение частоты запросов к музыкальным сервисам.
+
+Для каждого сервиса (и, где лимит считается по ключу или токену, для каждого
+ключа) ведется корзина токенов: запрос забирает токен, токены пополняются
+с заданной скоростью. Все потоки процесса используют общие корзины; между
+процессами и хостами лимит делится статически (RATE_LIMIT_PROCESSES).
+
+Получив 429, корзина приостанавливается на время из Retry-After (или на
+экспоненциальную задержку со случайным разбросом), а ее скорость снижается
+вдвое и затем постепенно восстанавливается до настроенной.
+"""
+
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+logger = logging.getLogger(__name__)
+
+# Запросов в секунду на сервис по умолчанию (на все процессы вместе)
+DEFAULT_RATE_LIMITS = {
+    'spotify': 10,
+    'deezer': 10,
+    'apple_music': 20,
+    'yandex_music': 5
+}
+
+
+def _parse_rate_limits(value):
+    """Разобрать строку вида 'spotify=10,deezer=10' в словарь лимитов"""
+    limits = {}
+    for item in (value or '').split(','):
+        if '=' not in item:
+            continue
+        name, limit = item.split('=', 1)
+        try:
+            limits[name.strip()] = float(limit)
+        except ValueError:
+            logger.warning(f"Некорректный лимит запросов для сервиса {name.strip()}: {limit}")
+    return limits
+
+
+def parse_retry_after(value):
+    """Получить задержку в секундах из заголовка Retry-After (число или HTTP-дата)"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class TokenBucket:
+    """Корзина токенов с паузой после 429 и адаптивной скоростью"""
+
+    def __init__(self, rate, burst=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        # Пока корзина на паузе, токены не пополняются
+        start = max(self.updated_at, self.paused_until)
+        if now > start:
+            self.tokens = min(self.capacity, self.tokens + (now - start) * self.rate)
+        self.updated_at = now
+
+    def acquire(self):
+        """Забрать токен, подождав, если корзина пуста или на паузе.
+
+        Токен резервируется сразу (баланс может уйти в минус), поэтому
+        ожидающие потоки обслуживаются по очереди, а не гонятся за
+        каждым новым токеном.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            wait = max(0.0, self.paused_until - now)
+            if self.tokens < 0:
+                wait += -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, delay):
+        """Приостановить корзину после 429 и снизить скорость вдвое.
+
+        Несколько 429 подряд от запросов, отправленных до паузы, снижают
+        скорость только один раз.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now >= self.paused_until:
+                self.rate = max(self.max_rate / 16, self.rate / 2)
+            self.paused_until = max(self.paused_until, now + delay)
+            self.tokens = min(self.tokens, 0.0)
+            self.throttled += 1
+
+    def record_success(self):
+        """Постепенно вернуть скорость к настроенной после успешного ответа"""
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+    def snapshot(self):
+        """Текущее состояние корзины"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return {
+                'rate': round(self.rate, 3),
+                'max_rate': round(self.max_rate, 3),
+                'tokens': round(self.tokens, 3),
+                'paused_for': round(max(0.0, self.paused_until - now), 3),
+                'throttled': self.throttled
+            }
+
+
+class RateLimiter:
+    """Общий для процесса реестр корзин токенов по сервисам и ключам доступа"""
+
+    def __init__(self, rate_limits=None):
+        self.rate_limits = dict(DEFAULT_RATE_LIMITS)
+        self.rate_limits.update(_parse_rate_limits(os.environ.get('RATE_LIMITS')))
+        if rate_limits:
+            self.rate_limits.update(rate_limits)
+        # Лимиты сервисов общие для всех процессов и хостов, поэтому каждый
+        # процесс получает свою долю
+        self.processes = max(1, int(os.environ.get('RATE_LIMIT_PROCESSES', 1)))
+        self.max_retries = int(os.environ.get('RATE_LIMIT_MAX_RETRIES', 5))
+        self.backoff_base = float(os.environ.get('RATE_LIMIT_BACKOFF_BASE', 1))
+        self.backoff_max = float(os.environ.get('RATE_LIMIT_BACKOFF_MAX', 60))
+
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, service, credential=None):
+        """Получить корзину сервиса (и ключа доступа, если он задан)"""
+        if credential:
+            # Токены и ключи в памяти не храним, только их отпечаток
+            credential = hashlib.sha256(credential.encode()).hexdigest()[:12]
+        key = (service, credential)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                rate = self.rate_limits.get(service)
+                if not rate:
+                    return None
+                bucket = TokenBucket(rate / self.processes)
+                self._buckets[key] = bucket
+            return bucket
+
+    def backoff_delay(self, attempt, retry_after=None):
+        """Задержка перед повтором: Retry-After от сервиса или экспоненциальная
+        задержка со случайным разбросом"""
+        retry_after = parse_retry_after(retry_after)
+        if retry_after is not None:
+            return min(self.backoff_max, retry_after) + random.uniform(0, self.backoff_base)
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return random.uniform(delay / 2, delay)
+
+    def limits(self):
+        """Текущие лимиты и состояние всех корзин"""
+        with self._lock:
+            buckets = list(self._buckets.items())
+        return {
+            f"{service}:{credential}" if credential else service: bucket.snapshot()
+            for (service, credential), bucket in buckets
+        }
+
+
+# Глобальный ограничитель частоты запросов
+rate_limiter = RateLimiter()
@@ -0,0 +1,250 @@
+"""
+Перенос старых данных из рабочих таблиц в архив.
+
+Удаленные треки, прочитанные уведомления, история отправленных уведомлений
+и обработанная очередь уведомлений растут без ограничений, а вместе с ними
+растут индексы горячих запросов. Задача хранения выгружает строки старше
+заданного срока в сжатые JSONL-файлы (по строке JSON на запись таблицы) и
+удаляет их из базы. Работа идет пачками по batch_size строк, каждая пачка -
+отдельная короткая транзакция, поэтому долгих блокировок нет.
+
+Пачка дописывается в файл отдельным gzip-блоком и сбрасывается на диск до
+удаления строк из базы. Если удаление не прошло, строки останутся и в базе,
+и в архиве; восстановление пропускает уже существующие строки, поэтому
+повторы безопасны.
+"""
+
+import gzip
+import json
+import logging
+import os
+from collections import Counter
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, delete, exists, select, update
+
+from services.bulk_loader import bulk_loader
+
+logger = logging.getLogger(__name__)
+
+# Порядок восстановления таблиц: сначала строки, на которые ссылаются другие
+RESTORE_ORDER = ('track', 'notification', 'notification_history', 'notification_outbox')
+
+
+class RetentionService:
+    """Архивация старых строк в сжатые JSONL-файлы и их восстановление"""
+    
+    def __init__(self):
+        self.archive_dir = os.environ.get('ARCHIVE_DIR', os.path.join('instance', 'archive'))
+        self.batch_size = max(1, int(os.environ.get('RETENTION_BATCH_SIZE', 500)))
+        # Сроки хранения в днях; 0 отключает архивацию этих данных
+        self.retention_days = {
+            'removed_tracks': int(os.environ.get('RETENTION_REMOVED_TRACK_DAYS', 180)),
+            'read_notifications': int(os.environ.get('RETENTION_READ_NOTIFICATION_DAYS', 90)),
+            'notification_history': int(os.environ.get('RETENTION_NOTIFICATION_HISTORY_DAYS', 365))
+        }
+    
+    def archive(self, now=None):
+        """Выгрузить в архив строки старше сроков хранения.
+        
+        Все данные одного запуска пишутся в один файл
+        ARCHIVE_DIR/archive-<время>.jsonl.gz. Возвращает пару (путь к файлу
+        или None, если архивировать нечего; число строк по таблицам).
+        
+        История уведомлений защищает от повторной отправки уведомления о том
+        же треке, поэтому после ее архивации трек, снова появившийся в
+        плейлисте, даст новое уведомление.
+        """
+        from app import Track, Notification, NotificationHistory, NotificationOutbox
+        
+        now = now or datetime.utcnow()
+        path = os.path.join(self.archive_dir, f"archive-{now:%Y%m%dT%H%M%S}.jsonl.gz")
+        counts = Counter()
+        
+        days = self.retention_days['read_notifications']
+        if days > 0:
+            cutoff = now - timedelta(days=days)
+            self._archive_rows(path, Notification, and_(
+                Notification.is_read == True, Notification.created_at < cutoff
+            ), counts)
+        
+        days = self.retention_days['removed_tracks']
+        if days > 0:
+            cutoff = now - timedelta(days=days)
+            # Уведомления ссылаются на трек, поэтому уходят в архив вместе с ним
+            self._archive_rows(path, Track, and_(
+                Track.is_removed == True, Track.removed_at < cutoff
+            ), counts, dependents=[(Notification, Notification.track_id)])
+        
+        days = self.retention_days['notification_history']
+        if days > 0:
+            cutoff = now - timedelta(days=days)
+            self._archive_rows(path, NotificationOutbox, and_(
+                NotificationOutbox.status != 'pending', NotificationOutbox.created_at < cutoff
+            ), counts)
+            # Записи истории, на которые еще ссылается очередь, не трогаем
+            self._archive_rows(path, NotificationHistory, and_(
+                NotificationHistory.sent_at < cutoff,
+                ~exists().where(NotificationOutbox.history_id == NotificationHistory.id)
+            ), counts)
+        
+        if not counts:
+            logger.info("Архивация: устаревших данных нет")
+            return None, {}
+        
+        summary = ', '.join(f"{table}: {count}" for table, count in counts.items())
+        logger.info(f"Архивация завершена, файл {path}. Перенесено строк - {summary}")
+        return path, dict(counts)
+    
+    def _archive_rows(self, path, model, condition, counts, dependents=()):
+        """Перенести в архив строки модели по условию, пачка за пачкой.
+        
+        dependents - пары (модель, столбец внешнего ключа) строк, которые
+        ссылаются на переносимые и должны уйти в архив вместе с ними.
+        """
+        from app import db
+        
+        table = model.__table__
+        while True:
+            ids = [row_id for (row_id,) in db.session.execute(
+                select(table.c.id).where(condition).order_by(table.c.id).limit(self.batch_size)
+            )]
+            if not ids:
+                return
+            
+            try:
+                rows = [dict(row) for row in db.session.execute(
+                    select(table).where(table.c.id.in_(ids))
+                ).mappings()]
+                batch = [(table, rows)]
+                for dependent, column in dependents:
+                    dependent_rows = [dict(row) for row in db.session.execute(
+                        select(dependent.__table__).where(column.in_(ids))
+                    ).mappings()]
+                    batch.append((dependent.__table__, dependent_rows))
+                
+                self._write_batch(path, batch)
+                
+                for batch_table, batch_rows in reversed(batch):
+                    if batch_rows:
+                        db.session.execute(delete(batch_table).where(
+                            batch_table.c.id.in_([row['id'] for row in batch_rows])
+                        ))
+                if table.name == 'track':
+                    self._adjust_track_counters(rows, -1)
+                db.session.commit()
+            except Exception as e:
+                logger.error(f"Ошибка архивации таблицы {table.name}: {str(e)}")
+                db.session.rollback()
+                raise
+            
+            for batch_table, batch_rows in batch:
+                if batch_rows:
+                    counts[batch_table.name] += len(batch_rows)
+    
+    def _write_batch(self, path, batch):
+        """Дописать пачку строк в архив отдельным gzip-блоком и сбросить на диск.
+        
+        Файл из нескольких gzip-блоков читается как один сжатый поток.
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'ab') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='ab') as archive:
+                for table, rows in batch:
+                    for row in rows:
+                        record = {'table': table.name, 'row': row}
+                        archive.write(json.dumps(record, ensure_ascii=False, default=_encode_value).encode('utf-8'))
+                        archive.write(b'\n')
+            raw.flush()
+            os.fsync(raw.fileno())
+    
+    def restore(self, path):
+        """Вернуть в базу строки из файла архива.
+        
+        Таблицы восстанавливаются в порядке RESTORE_ORDER, чтобы строки, на
+        которые ссылаются другие, появились раньше. Строки, которые уже есть в
+        базе, пропускаются. Счетчики треков плейлистов увеличиваются на
+        действительно вставленные треки. Возвращает число вставленных строк
+        по таблицам.
+        """
+        from app import db
+        
+        counts = Counter()
+        for table_name in RESTORE_ORDER:
+            table = db.metadata.tables[table_name]
+            batch = []
+            for record in self._read_archive(path):
+                if record['table'] != table_name:
+                    continue
+                batch.append(_decode_row(table, record['row']))
+                if len(batch) >= self.batch_size:
+                    counts[table_name] += self._restore_batch(table, batch)
+                    batch = []
+            if batch:
+                counts[table_name] += self._restore_batch(table, batch)
+        
+        summary = ', '.join(f"{table}: {count}" for table, count in counts.items() if count) or 'нет новых строк'
+        logger.info(f"Восстановление из {path} завершено - {summary}")
+        return {table: count for table, count in counts.items() if count}
+    
+    def _read_archive(self, path):
+        """Читать записи архива по одной"""
+        with gzip.open(path, 'rt', encoding='utf-8') as archive:
+            for line in archive:
+                if line.strip():
+                    yield json.loads(line)
+    
+    def _restore_batch(self, table, rows):
+        """Вставить пачку строк, пропуская уже существующие, одной транзакцией"""
+        from app import db
+        
+        try:
+            # RETURNING возвращает только действительно вставленные строки
+            columns = [table.c.id]
+            if table.name == 'track':
+                columns += [table.c.playlist_id, table.c.is_removed]
+            inserted = [row._asdict() for row in bulk_loader.insert(db.session, table, rows, returning=columns)]
+            if table.name == 'track':
+                self._adjust_track_counters(inserted, 1)
+            db.session.commit()
+        except Exception as e:
+            logger.error(f"Ошибка восстановления таблицы {table.name}: {str(e)}")
+            db.session.rollback()
+            raise
+        return len(inserted)
+    
+    def _adjust_track_counters(self, rows, sign):
+        """Изменить счетчики треков плейлистов на перенесенные строки треков.
+        
+        sign = -1 при удалении в архив, 1 при восстановлении.
+        """
+        from app import db, Playlist
+        
+        removed = Counter(row['playlist_id'] for row in rows if row['is_removed'])
+        active = Counter(row['playlist_id'] for row in rows if not row['is_removed'])
+        for playlist_id in set(removed) | set(active):
+            db.session.execute(update(Playlist).where(Playlist.id == playlist_id).values(
+                total_tracks=Playlist.total_tracks + sign * (removed[playlist_id] + active[playlist_id]),
+                active_tracks=Playlist.active_tracks + sign * active[playlist_id],
+                removed_tracks=Playlist.removed_tracks + sign * removed[playlist_id]
+            ), execution_options={'synchronize_session': False})
+
+
+def _encode_value(value):
+    """Сериализация значений, которых нет в JSON (время - в ISO 8601)"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Значение типа {type(value).__name__} не сериализуется в JSON")
+
+
+def _decode_row(table, row):
+    """Вернуть значениям столбцов с датой тип datetime"""
+    for column in table.columns:
+        value = row.get(column.name)
+        if isinstance(value, str) and column.type.python_type is datetime:
+            row[column.name] = datetime.fromisoformat(value)
+    return row
+
+
+# Глобальный экземпляр сервиса хранения данных
+retention_service = RetentionService()
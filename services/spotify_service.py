@@ -1,8 +1,16 @@
 import spotipy
+from spotipy.cache_handler import MemoryCacheHandler
 from spotipy.oauth2 import SpotifyOAuth
+import itertools
 import os
+import threading
+from collections import OrderedDict
+from services.http_client import http_client
 from flask_babel import gettext
 
+# Сколько клиентов spotipy (по одному на токен доступа) держать в кэше
+CLIENT_CACHE_SIZE = 256
+
 
 class TokenExpiredError(Exception):
     """Исключение для истекших токенов"""
@@ -18,42 +26,66 @@ class SpotifyService:
         self.redirect_uri = os.environ.get('SPOTIFY_REDIRECT_URI')
         
         self.scope = "playlist-read-private playlist-read-collaborative user-library-read"
+        self.http = http_client.session('spotify')
+        
+        # Объект OAuth и клиенты spotipy создаются один раз и переиспользуются
+        self._oauth = None
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
         
+    def _get_oauth(self):
+        """Получить общий объект SpotifyOAuth.
+        
+        Токены хранятся в памяти объекта, а не в файле .cache, и никогда не
+        читаются из него: кэш общий для всех пользователей.
+        """
+        with self._lock:
+            if self._oauth is None:
+                self._oauth = SpotifyOAuth(
+                    client_id=self.client_id,
+                    client_secret=self.client_secret,
+                    redirect_uri=self.redirect_uri,
+                    scope=self.scope,
+                    cache_handler=MemoryCacheHandler(),
+                    requests_session=self.http,
+                    requests_timeout=http_client.timeout
+                )
+            return self._oauth
+    
     def get_auth_url(self):
         """Получить URL для авторизации"""
-        sp_oauth = SpotifyOAuth(
-            client_id=self.client_id,
-            client_secret=self.client_secret,
-            redirect_uri=self.redirect_uri,
-            scope=self.scope
-        )
-        return sp_oauth.get_authorize_url()
+        return self._get_oauth().get_authorize_url()
     
     def get_access_token(self, code):
         """Получить токен доступа по коду авторизации"""
-        sp_oauth = SpotifyOAuth(
-            client_id=self.client_id,
-            client_secret=self.client_secret,
-            redirect_uri=self.redirect_uri,
-            scope=self.scope
-        )
-        token_info = sp_oauth.get_access_token(code)
+        # check_cache=False: иначе spotipy вернул бы токен, закэшированный
+        # для другого пользователя
+        token_info = self._get_oauth().get_access_token(code, check_cache=False)
         return token_info
     
     def refresh_access_token(self, refresh_token):
         """Обновить токен доступа"""
-        sp_oauth = SpotifyOAuth(
-            client_id=self.client_id,
-            client_secret=self.client_secret,
-            redirect_uri=self.redirect_uri,
-            scope=self.scope
-        )
-        token_info = sp_oauth.refresh_access_token(refresh_token)
+        token_info = self._get_oauth().refresh_access_token(refresh_token)
         return token_info
     
     def get_client(self, access_token):
-        """Получить клиент Spotify с токеном"""
-        return spotipy.Spotify(auth=access_token)
+        """Получить клиент Spotify с токеном.
+        
+        Клиенты кэшируются по токену и используют общую сессию с пулом
+        соединений; повторы при 429/5xx выполняет адаптер сессии.
+        """
+        with self._lock:
+            client = self._clients.get(access_token)
+            if client is not None:
+                self._clients.move_to_end(access_token)
+                return client
+            
+            client = spotipy.Spotify(auth=access_token, requests_session=self.http,
+                                     requests_timeout=http_client.timeout)
+            self._clients[access_token] = client
+            if len(self._clients) > CLIENT_CACHE_SIZE:
+                self._clients.popitem(last=False)
+            return client
     
     def get_playlist_info(self, access_token, playlist_url, refresh_token=None):
         """Получить информацию о плейлисте"""
@@ -72,66 +104,147 @@ class SpotifyService:
                 'description': playlist['description'],
                 'tracks_count': playlist['tracks']['total'],
                 'owner': playlist['owner']['display_name'],
-                'public': playlist['public']
+                'public': playlist['public'],
+                'snapshot_id': playlist.get('snapshot_id')
             }
         except Exception as e:
-            # Проверяем, является ли ошибка связанной с истекшим токеном
-            if (("401" in str(e) or "access token expired" in str(e).lower() or
-                 "invalid access token" in str(e).lower()) and refresh_token):
-                # Пытаемся обновить токен
-                try:
-                    new_token_info = self.refresh_access_token(refresh_token)
-                    # Возвращаем информацию о новом токене вместе с ошибкой
-                    raise TokenExpiredError("Токен истек", new_token_info)
-                except Exception as refresh_error:
-                    raise Exception(gettext('service.spotify.token_refresh_error', error=str(refresh_error)))
-            raise Exception(gettext('service.spotify.playlist_info_error', error=str(e)))
+            self._raise_api_error(e, refresh_token, 'service.spotify.playlist_info_error')
     
-    def get_playlist_tracks(self, access_token, playlist_id, refresh_token=None):
-        """Получить треки плейлиста"""
+    def get_playlist_snapshot_id(self, access_token, playlist_id, refresh_token=None):
+        """Получить snapshot_id плейлиста одним легким запросом.
+        
+        snapshot_id меняется при любом изменении состава плейлиста, поэтому
+        совпадение с сохраненным значением означает, что треки не изменились.
+        """
         sp = self.get_client(access_token)
         
-        tracks = []
-        offset = 0
+        try:
+            playlist = sp.playlist(playlist_id, fields='snapshot_id')
+            return playlist.get('snapshot_id')
+        except Exception as e:
+            self._raise_api_error(e, refresh_token, 'service.spotify.playlist_info_error')
+    
+    def _iter_pages(self, fetch_page, limit):
+        """Загрузить первую страницу сразу, а остальные - лениво при чтении.
+        
+        Ошибки первого запроса (в том числе истекший токен) выбрасываются
+        сразу, а не при разборе результата.
+        """
+        first_page = fetch_page(0)
+        if not first_page['items']:
+            return iter([first_page])
+        return itertools.chain(
+            [first_page], http_client.iter_pages(fetch_page, range(limit, first_page['total'], limit)))
+    
+    def get_playlist_track_ids(self, access_token, playlist_id, refresh_token=None):
+        """Получить только ID треков плейлиста списком"""
+        return list(self.iter_playlist_track_ids(access_token, playlist_id, refresh_token))
+    
+    def iter_playlist_track_ids(self, access_token, playlist_id, refresh_token=None):
+        """Итератор по ID треков плейлиста (компактный режим для проверки).
+        
+        Фильтр fields= оставляет в ответе лишь ID треков, поэтому страницы в разы
+        меньше полных. Метаданные новых треков догружаются get_tracks_metadata.
+        Локальные файлы пользователя не имеют ID и пропускаются.
+        """
+        sp = self.get_client(access_token)
         limit = 100
         
-        while True:
+        def fetch_page(offset):
             try:
-                results = sp.playlist_tracks(playlist_id, offset=offset, limit=limit)
-                if not results['items']:
-                    break
-                
-                for item in results['items']:
-                    if item['track']:  # Проверяем, что трек не удален
-                        track = item['track']
-                        tracks.append({
-                            'id': track['id'],
-                            'name': track['name'],
-                            'artist': ', '.join([artist['name'] for artist in track['artists']]),
-                            'album': track['album']['name'],
-                            'duration': track['duration_ms'] // 1000,  # Конвертируем в секунды
-                            'added_at': item['added_at']
-                        })
-                
-                offset += limit
-                if offset >= results['total']:
-                    break
-                    
+                return sp.playlist_items(playlist_id, fields='items(track(id)),total',
+                                         limit=limit, offset=offset, additional_types=('track',))
+            except Exception as e:
+                self._raise_api_error(e, refresh_token, 'service.spotify.playlist_tracks_error')
+        
+        return (item['track']['id'] for page in self._iter_pages(fetch_page, limit) for item in page['items']
+                if item['track'] and item['track']['id'])
+    
+    def get_tracks_metadata(self, access_token, track_ids):
+        """Получить данные треков по списку ID (пачками по 50, как позволяет API)"""
+        sp = self.get_client(access_token)
+        batch_size = 50
+        
+        def fetch_batch(start):
+            try:
+                return sp.tracks(track_ids[start:start + batch_size])['tracks']
             except Exception as e:
-                # Проверяем, является ли ошибка связанной с истекшим токеном
-                if (("401" in str(e) or "access token expired" in str(e).lower() or
-                     "invalid access token" in str(e).lower()) and refresh_token):
-                    # Пытаемся обновить токен
-                    try:
-                        new_token_info = self.refresh_access_token(refresh_token)
-                        # Возвращаем информацию о новом токене вместе с ошибкой
-                        raise TokenExpiredError("Токен истек", new_token_info)
-                    except Exception as refresh_error:
-                        raise Exception(gettext('service.spotify.token_refresh_error', error=str(refresh_error)))
                 raise Exception(gettext('service.spotify.playlist_tracks_error', error=str(e)))
         
+        batches = http_client.fetch_pages(fetch_batch, range(0, len(track_ids), batch_size))
+        
+        tracks = []
+        for track_id, track in zip(track_ids, (track for batch in batches for track in batch)):
+            if not track:
+                # Трек недоступен в каталоге: сохраняем его без метаданных
+                tracks.append({'id': track_id, 'name': 'Unknown', 'artist': 'Unknown',
+                               'album': '', 'duration': 0, 'added_at': None})
+                continue
+            tracks.append({
+                'id': track['id'],
+                'name': track['name'],
+                'artist': ', '.join([artist['name'] for artist in track['artists']]),
+                'album': track['album']['name'],
+                'duration': track['duration_ms'] // 1000,  # Конвертируем в секунды
+                'added_at': None  # Время добавления есть только в списке треков плейлиста
+            })
+        
         return tracks
     
+    def _raise_api_error(self, error, refresh_token, message_key):
+        """Преобразовать ошибку API: при истекшем токене обновить его и
+        выбросить TokenExpiredError, иначе - исключение с сообщением message_key"""
+        if isinstance(error, TokenExpiredError):
+            raise error
+        message = str(error).lower()
+        expired = (getattr(error, 'http_status', None) == 401 or
+                   "access token expired" in message or "invalid access token" in message)
+        if expired and refresh_token:
+            try:
+                new_token_info = self.refresh_access_token(refresh_token)
+            except Exception as refresh_error:
+                raise Exception(gettext('service.spotify.token_refresh_error', error=str(refresh_error)))
+            # Возвращаем информацию о новом токене вместе с ошибкой
+            raise TokenExpiredError("Токен истек", new_token_info)
+        raise Exception(gettext(message_key, error=str(error)))
+    
+    def get_playlist_tracks(self, access_token, playlist_id, refresh_token=None):
+        """Получить треки плейлиста списком"""
+        return list(self.iter_playlist_tracks(access_token, playlist_id, refresh_token))
+    
+    def iter_playlist_tracks(self, access_token, playlist_id, refresh_token=None):
+        """Итератор по трекам плейлиста.
+        
+        Первая страница сообщает общее количество треков, после чего остальные
+        страницы загружаются параллельно по мере чтения и отдаются в исходном
+        порядке.
+        """
+        sp = self.get_client(access_token)
+        limit = 100
+        
+        def fetch_page(offset):
+            try:
+                return sp.playlist_tracks(playlist_id, offset=offset, limit=limit)
+            except Exception as e:
+                self._raise_api_error(e, refresh_token, 'service.spotify.playlist_tracks_error')
+        
+        return self._parse_playlist_items(self._iter_pages(fetch_page, limit))
+    
+    def _parse_playlist_items(self, pages):
+        """Разобрать треки из страниц ответа по мере их загрузки"""
+        for results in pages:
+            for item in results['items']:
+                if item['track']:  # Проверяем, что трек не удален
+                    track = item['track']
+                    yield {
+                        'id': track['id'],
+                        'name': track['name'],
+                        'artist': ', '.join([artist['name'] for artist in track['artists']]),
+                        'album': track['album']['name'],
+                        'duration': track['duration_ms'] // 1000,  # Конвертируем в секунды
+                        'added_at': item['added_at']
+                    }
+    
     def _extract_playlist_id(self, url):
         """Извлечь ID плейлиста из URL"""
         import re
@@ -180,17 +293,7 @@ class SpotifyService:
                     break
                     
             except Exception as e:
-                # Проверяем, является ли ошибка связанной с истекшим токеном
-                if (("401" in str(e) or "access token expired" in str(e).lower() or
-                     "invalid access token" in str(e).lower()) and refresh_token):
-                    # Пытаемся обновить токен
-                    try:
-                        new_token_info = self.refresh_access_token(refresh_token)
-                        # Возвращаем информацию о новом токене вместе с ошибкой
-                        raise TokenExpiredError("Токен истек", new_token_info)
-                    except Exception as refresh_error:
-                        raise Exception(gettext('service.spotify.token_refresh_error', error=str(refresh_error)))
-                raise Exception(gettext('service.spotify.user_playlists_error', error=str(e)))
+                self._raise_api_error(e, refresh_token, 'service.spotify.user_playlists_error')
         
         return playlists
     
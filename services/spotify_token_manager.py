@@ -0,0 +1,162 @@
+"""
+Менеджер токенов доступа Spotify.
+
+Токены пользователей кэшируются в памяти процесса, поэтому проверка плейлиста
+не обращается к базе за токеном. Токен, которому осталось жить меньше
+refresh_margin, обновляется до запроса к API, а фоновая задача заранее
+обновляет пачкой все токены, истекающие в ближайшее время. Так проверка не
+начинает постраничную загрузку с токеном, который истечет посреди нее.
+
+База данных остается источником истины: перед обновлением токен перечитывается
+из нее, и если его уже обновил другой процесс, повторного обновления не будет.
+"""
+
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+
+class SpotifyTokenManager:
+    """Кэш и упреждающее обновление токенов Spotify"""
+
+    def __init__(self, spotify_service, refresh_margin=None, lookahead=None):
+        self.service = spotify_service
+        # За сколько секунд до истечения токен считается устаревшим
+        self.refresh_margin = timedelta(seconds=int(
+            refresh_margin or os.environ.get('SPOTIFY_TOKEN_REFRESH_MARGIN', 300)))
+        # Какие токены обновляет фоновая задача: истекающие в ближайшие N секунд
+        self.lookahead = timedelta(seconds=int(
+            lookahead or os.environ.get('SPOTIFY_TOKEN_LOOKAHEAD', 900)))
+
+        self._tokens = {}  # user_id -> (access_token, refresh_token, expires_at)
+        self._user_locks = {}
+        self._lock = threading.Lock()
+
+    def _user_lock(self, user_id):
+        with self._lock:
+            lock = self._user_locks.get(user_id)
+            if lock is None:
+                lock = self._user_locks[user_id] = threading.Lock()
+            return lock
+
+    def _is_fresh(self, entry, now=None):
+        return entry is not None and entry[2] - self.refresh_margin > (now or datetime.utcnow())
+
+    def get_access_token(self, user_id):
+        """Получить действующий токен доступа пользователя или None"""
+        entry = self._tokens.get(user_id)
+        if self._is_fresh(entry):
+            return entry[0]
+
+        # Обновлением токена одного пользователя занимается один поток
+        with self._user_lock(user_id):
+            entry = self._tokens.get(user_id)
+            if self._is_fresh(entry):
+                return entry[0]
+            entry = self._load_or_refresh(user_id)
+            return entry[0] if entry else None
+
+    def get_refresh_token(self, user_id):
+        """Получить refresh token пользователя (из кэша или базы)"""
+        entry = self._tokens.get(user_id) or self._load(user_id)
+        return entry[1] if entry else None
+
+    def store_token(self, user_id, token_info):
+        """Сохранить новый токен (например, полученный при ошибке 401) в базу и кэш"""
+        from app import db, SpotifyToken
+
+        token_record = SpotifyToken.query.filter_by(user_id=user_id).first()
+        if not token_record:
+            return None
+
+        self._apply_token_info(token_record, token_info)
+        db.session.commit()
+        return self._remember(token_record)
+
+    def invalidate(self, user_id):
+        """Забыть закэшированный токен (после повторной авторизации пользователя)"""
+        self._tokens.pop(user_id, None)
+
+    def refresh_expiring(self):
+        """Заранее обновить токены, истекающие в ближайшие lookahead секунд.
+
+        Обновляются только токены пользователей, у которых есть плейлисты
+        Spotify. Каждый токен фиксируется в базе сразу после обновления,
+        чтобы не потерять новый refresh token, если Spotify его сменил.
+        Возвращает количество обновленных токенов.
+        """
+        from app import db, SpotifyToken, Playlist
+
+        deadline = datetime.utcnow() + self.lookahead
+        user_ids = [user_id for (user_id,) in db.session.query(SpotifyToken.user_id).filter(
+            SpotifyToken.expires_at < deadline,
+            SpotifyToken.user_id.in_(
+                db.session.query(Playlist.user_id).filter(Playlist.service == 'spotify')
+            )
+        ).distinct()]
+
+        refreshed = 0
+        for user_id in user_ids:
+            with self._user_lock(user_id):
+                entry = self._load(user_id)
+                if entry is None or entry[2] >= deadline:
+                    continue
+                if self._refresh(user_id):
+                    refreshed += 1
+
+        if user_ids:
+            logger.info(f"Токенов Spotify обновлено заранее: {refreshed} из {len(user_ids)}")
+        return refreshed
+
+    def _load_or_refresh(self, user_id):
+        """Прочитать токен из базы и обновить его, если он устаревает"""
+        entry = self._load(user_id)
+        if entry is None or self._is_fresh(entry):
+            return entry
+        return self._refresh(user_id)
+
+    def _load(self, user_id):
+        """Прочитать токен из базы в кэш"""
+        from app import SpotifyToken
+
+        token_record = SpotifyToken.query.filter_by(user_id=user_id).first()
+        if not token_record:
+            self._tokens.pop(user_id, None)
+            return None
+        return self._remember(token_record)
+
+    def _refresh(self, user_id):
+        """Обновить токен через Spotify и сохранить его"""
+        from app import db, SpotifyToken
+
+        token_record = SpotifyToken.query.filter_by(user_id=user_id).first()
+        if not token_record:
+            return None
+
+        try:
+            token_info = self.service.refresh_access_token(token_record.refresh_token)
+        except Exception as e:
+            logger.error(f"Ошибка обновления токена Spotify для пользователя {user_id}: {str(e)}")
+            # Токен мог быть уже обновлен другим процессом: вернем то, что есть в базе
+            db.session.rollback()
+            entry = self._load(user_id)
+            return entry if entry and entry[2] > datetime.utcnow() else None
+
+        self._apply_token_info(token_record, token_info)
+        db.session.commit()
+        logger.info(f"Токен Spotify для пользователя {user_id} успешно обновлен")
+        return self._remember(token_record)
+
+    def _apply_token_info(self, token_record, token_info):
+        token_record.access_token = token_info['access_token']
+        if token_info.get('refresh_token'):
+            token_record.refresh_token = token_info['refresh_token']
+        token_record.expires_at = datetime.utcnow() + timedelta(seconds=token_info['expires_in'])
+
+    def _remember(self, token_record):
+        entry = (token_record.access_token, token_record.refresh_token, token_record.expires_at)
+        self._tokens[token_record.user_id] = entry
+        return entry
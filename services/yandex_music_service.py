@@ -1,11 +1,31 @@
-import requests
+from services.http_client import HashingReader, http_client
 from datetime import datetime
 from flask_babel import gettext
+import shutil
+import tempfile
+
+try:
+    import ijson
+except ImportError:
+    # Без ijson ответ разбирается целиком через response.json()
+    ijson = None
+
+# Поля плейлиста, которые собираются при потоковом разборе ответа
+STREAM_INFO_FIELDS = {
+    'result.kind': 'kind',
+    'result.title': 'title',
+    'result.description': 'description',
+    'result.trackCount': 'trackCount',
+    'result.visibility': 'visibility'
+}
+STREAM_TRACK_PREFIX = 'result.tracks.item'
+# Размер тела ответа, до которого оно буферизуется в памяти, а не во временном файле
+STREAM_SPOOL_SIZE = 1024 * 1024
 
 
 class YandexMusicService:
     def __init__(self):
-        pass
+        self.http = http_client.session('yandex_music')
     
     def _extract_playlist_id(self, url):
         """Извлечь ID плейлиста из URL"""
@@ -43,27 +63,90 @@ class YandexMusicService:
                 'Accept': 'application/json',
             }
             
-            response = requests.get(url, headers=headers)
+            response = self.http.get(url, headers=headers)
             
             if response.status_code == 200:
                 data = response.json()
-                result = data['result']
-                return {
-                    'id': str(result['kind']),
-                    'name': result['title'],
-                    'description': result.get('description', ''),
-                    'tracks_count': result['trackCount'],
-                    'owner': result['owner']['name'],
-                    'public': result.get('visibility') == 'public'
-                }
+                return self._public_playlist_info(data['result'])
             else:
                 raise Exception(gettext('service.yandex_music.api_error', status_code=response.status_code, response_text=response.text))
                 
         except Exception as e:
             raise Exception(gettext('service.yandex_music.playlist_info_error', error=str(e)))
     
+    def _public_playlist_info(self, result):
+        """Разобрать информацию о плейлисте из ответа API"""
+        return {
+            'id': str(result['kind']),
+            'name': result['title'],
+            'description': result.get('description', ''),
+            'tracks_count': result['trackCount'],
+            'owner': result['owner']['name'],
+            'public': result.get('visibility') == 'public'
+        }
+    
+    def _parse_track(self, track):
+        """Разобрать трек из ответа API"""
+        return {
+            'id': str(track['id']),
+            'name': track['title'],
+            'artist': ', '.join([artist['name'] for artist in track['artists']]),
+            'album': track['albums'][0]['title'] if track['albums'] else '',
+            'duration': track['durationMs'] // 1000,  # Конвертируем в секунды
+            'added_at': datetime.utcnow().isoformat()  # Yandex Music не предоставляет время добавления
+        }
+    
+    def _parse_playlist_stream(self, body, fetch_result):
+        """Итератор по трекам из сохраненного тела ответа с плейлистом.
+        
+        Дерево JSON целиком не строится, а треки отдаются по одному: в памяти
+        одновременно находится только текущий трек. Когда тело прочитано до
+        конца, в fetch_result записывается информация о плейлисте.
+        """
+        result = {'owner': {}}
+        builder = None
+        
+        try:
+            with body:
+                for prefix, event, value in ijson.parse(body, use_float=True):
+                    if builder is not None:
+                        builder.event(event, value)
+                        if prefix == STREAM_TRACK_PREFIX and event == 'end_map':
+                            yield self._parse_track(builder.value['track'])
+                            builder = None
+                    elif prefix == STREAM_TRACK_PREFIX and event == 'start_map':
+                        builder = ijson.ObjectBuilder()
+                        builder.event(event, value)
+                    elif event in ('string', 'number', 'boolean', 'null'):
+                        if prefix in STREAM_INFO_FIELDS:
+                            result[STREAM_INFO_FIELDS[prefix]] = value
+                        elif prefix == 'result.owner.name':
+                            result['owner']['name'] = value
+            
+            fetch_result['info'] = self._public_playlist_info(result)
+        except Exception as e:
+            raise Exception(gettext('service.yandex_music.playlist_tracks_error', error=str(e)))
+    
     def get_public_playlist_tracks(self, playlist_url):
         """Получить треки публичного плейлиста без авторизации"""
+        return list(self.get_public_playlist(playlist_url)['tracks'])
+    
+    def get_public_playlist(self, playlist_url, etag=None, last_modified=None, content_hash=None):
+        """Получить информацию о публичном плейлисте и его треки одним запросом.
+        
+        Запрос отправляется с валидаторами прошлой проверки; при ответе 304
+        или совпадении хэша тела JSON не разбирается. Если установлен ijson,
+        тело сначала копируется во временный файл (небольшое - в память) с
+        подсчетом хэша, и только изменившийся ответ разбирается потоково по
+        мере чтения tracks: пиковая память не растет вместе с размером
+        плейлиста. info тогда заполняется, когда tracks прочитан до конца.
+        
+        Возвращает словарь:
+            info      - информация о плейлисте (None, если не изменился)
+            tracks    - итератор по трекам (None, если не изменился)
+            unchanged - True, если плейлист не изменился
+            state     - новые валидаторы для сохранения в Playlist
+        """
         playlist_id = self._extract_playlist_id(playlist_url)
         if not playlist_id:
             raise ValueError(gettext('service.yandex_music.invalid_playlist_url'))
@@ -77,28 +160,42 @@ class YandexMusicService:
                 'Accept': 'application/json',
             }
             
-            response = requests.get(url, headers=headers)
+            stream = ijson is not None
+            response, validators = http_client.conditional_get(
+                self.http, url, etag=etag, last_modified=last_modified,
+                content_hash=content_hash, headers=headers, stream=stream
+            )
+            
+            if response is None:
+                return {'info': None, 'tracks': None, 'unchanged': True, 'state': validators}
             
             if response.status_code == 200:
-                data = response.json()
-                result = data['result']
-                tracks = []
+                if stream:
+                    body = tempfile.SpooledTemporaryFile(max_size=STREAM_SPOOL_SIZE)
+                    try:
+                        with response:
+                            reader = HashingReader(response)
+                            shutil.copyfileobj(reader, body)
+                    except Exception:
+                        body.close()
+                        raise
+                    
+                    validators['content_hash'] = reader.hexdigest()
+                    if content_hash and validators['content_hash'] == content_hash:
+                        body.close()
+                        return {'info': None, 'tracks': None, 'unchanged': True, 'state': validators}
+                    
+                    body.seek(0)
+                    fetch_result = {'info': None, 'tracks': None, 'unchanged': False, 'state': validators}
+                    fetch_result['tracks'] = self._parse_playlist_stream(body, fetch_result)
+                    return fetch_result
                 
-                for track_data in result['tracks']:
-                    track = track_data['track']
-                    tracks.append({
-                        'id': str(track['id']),
-                        'name': track['title'],
-                        'artist': ', '.join([artist['name'] for artist in track['artists']]),
-                        'album': track['albums'][0]['title'] if track['albums'] else '',
-                        'duration': track['durationMs'] // 1000,  # Конвертируем в секунды
-                        'added_at': datetime.utcnow().isoformat()  # Yandex Music не предоставляет время добавления
-                    })
-                
-                return tracks
+                result = response.json()['result']
+                tracks = [self._parse_track(track_data['track']) for track_data in result['tracks']]
+                return {'info': self._public_playlist_info(result), 'tracks': tracks,
+                        'unchanged': False, 'state': validators}
             else:
                 raise Exception(gettext('service.yandex_music.api_error', status_code=response.status_code, response_text=response.text))
                 
         except Exception as e:
             raise Exception(gettext('service.yandex_music.playlist_tracks_error', error=str(e)))
-    
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Регрессионные тесты планов горячих запросов.
+
+Схема создается по моделям, заполняется тестовыми данными, и для каждого
+горячего запроса выполняется EXPLAIN. Тест падает, если запрос читает
+таблицу последовательным сканированием (значит, подходящего индекса нет)
+или сортирует результат вместо чтения в порядке индекса.
+
+SQLite проверяется всегда (база в памяти). Postgres проверяется, если задан
+TEST_POSTGRES_URL - адрес отдельной тестовой базы: таблицы в ней создаются
+и удаляются тестом. В Postgres последовательное сканирование запрещается
+(enable_seqscan = off), поэтому оно в плане означает, что индекса нет.
+"""
+
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, insert, select, text
+
+os.environ.setdefault('SCHEDULER_ENABLED', 'false')
+
+from app import db, User, Playlist, Track, CatalogTrack, PlaylistVersion, Notification, NotificationHistory
+
+USERS = 20
+PLAYLISTS_PER_USER = 5
+TRACKS_PER_PLAYLIST = 200
+NOTIFICATIONS_PER_USER = 100
+VERSIONS_PER_PLAYLIST = 20
+
+
+def hot_queries():
+    """Горячие запросы: (название, запрос, нужен ли порядок из индекса)"""
+    return [
+        ('active_tracks', select(
+            Track.id, Track.service_track_id, Track.catalog_track_id
+        ).where(Track.playlist_id == 7, Track.is_removed == False), False),
+        ('track_in_playlist', select(Track.id).where(
+            Track.playlist_id == 7, Track.service_track_id == 'track-54', Track.is_removed == False
+        ), False),
+        ('catalog_tracks', select(CatalogTrack.id, CatalogTrack.service_track_id).where(
+            CatalogTrack.service == 'deezer', CatalogTrack.service_track_id.in_(['track-5', 'track-9'])
+        ), False),
+        ('unread_notifications', select(Notification).where(
+            Notification.user_id == 3, Notification.is_read == False
+        ).order_by(Notification.created_at.desc()).limit(10), True),
+        ('existing_playlist', select(Playlist.id).where(
+            Playlist.user_id == 3, Playlist.service == 'deezer', Playlist.service_playlist_id == 'playlist-3-1'
+        ), False),
+        ('notification_history_page', select(NotificationHistory).where(
+            NotificationHistory.user_id == 3
+        ).order_by(NotificationHistory.sent_at.desc()).limit(20), True),
+        ('latest_playlist_version', select(PlaylistVersion.version, PlaylistVersion.checkpoint_version).where(
+            PlaylistVersion.playlist_id == 7
+        ).order_by(PlaylistVersion.version.desc()).limit(1), True),
+        ('playlist_checkpoint_at', select(PlaylistVersion).where(
+            PlaylistVersion.playlist_id == 7, PlaylistVersion.is_checkpoint == True,
+            PlaylistVersion.created_at <= datetime(2030, 1, 1)
+        ).order_by(PlaylistVersion.created_at.desc()).limit(1), True),
+    ]
+
+
+def seed(engine):
+    """Создать схему и заполнить ее данными"""
+    db.metadata.create_all(engine)
+    now = datetime.utcnow()
+
+    users = [{'id': u, 'username': f'user{u}', 'email': f'user{u}@example.com', 'password_hash': 'x'}
+             for u in range(1, USERS + 1)]
+    catalog = [{'id': t + 1, 'service': 'deezer', 'service_track_id': f'track-{t}',
+                'name': f'Track {t}', 'artist': 'Artist'} for t in range(TRACKS_PER_PLAYLIST * 2)]
+    playlists = []
+    tracks = []
+    notifications = []
+    history = []
+    versions = []
+    for user in users:
+        for p in range(PLAYLISTS_PER_USER):
+            playlist_id = len(playlists) + 1
+            playlists.append({
+                'id': playlist_id, 'user_id': user['id'], 'service': 'deezer',
+                'service_playlist_id': f"playlist-{user['id']}-{p}", 'name': f'Playlist {playlist_id}'
+            })
+            for t in range(TRACKS_PER_PLAYLIST):
+                # Плейлисты частично пересекаются по трекам
+                catalog_track = catalog[(playlist_id * 7 + t) % len(catalog)]
+                tracks.append({
+                    'id': len(tracks) + 1, 'playlist_id': playlist_id, 'catalog_track_id': catalog_track['id'],
+                    'service_track_id': catalog_track['service_track_id'],
+                    'is_removed': t % 10 == 0, 'added_at': now
+                })
+            for v in range(1, VERSIONS_PER_PLAYLIST + 1):
+                checkpoint = (v - 1) // 5 * 5 + 1
+                versions.append({
+                    'playlist_id': playlist_id, 'version': v, 'checkpoint_version': checkpoint,
+                    'is_checkpoint': v == checkpoint, 'added_ids': '[]', 'removed_ids': '[]',
+                    'track_count': 0, 'created_at': now - timedelta(hours=VERSIONS_PER_PLAYLIST - v)
+                })
+        first_track = (user['id'] - 1) * PLAYLISTS_PER_USER * TRACKS_PER_PLAYLIST + 1
+        first_playlist = (user['id'] - 1) * PLAYLISTS_PER_USER + 1
+        for n in range(NOTIFICATIONS_PER_USER):
+            created_at = now - timedelta(minutes=n)
+            notifications.append({
+                'user_id': user['id'], 'playlist_id': first_playlist, 'track_id': first_track + n,
+                'message': 'm', 'is_read': n % 3 != 0, 'created_at': created_at
+            })
+            history.append({
+                'user_id': user['id'], 'playlist_id': first_playlist, 'notification_type': 'track_added',
+                'track_service_id': f'track-{n}', 'message': 'm', 'sent_at': created_at
+            })
+
+    with engine.begin() as conn:
+        for model, rows in ((User, users), (CatalogTrack, catalog), (Playlist, playlists), (Track, tracks),
+                            (PlaylistVersion, versions), (Notification, notifications), (NotificationHistory, history)):
+            conn.execute(insert(model), rows)
+        conn.execute(text('ANALYZE'))
+
+
+def explain(conn, query):
+    """Получить план запроса строками"""
+    sql = str(query.compile(dialect=conn.dialect, compile_kwargs={'literal_binds': True}))
+    if conn.dialect.name == 'sqlite':
+        return [row[-1] for row in conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {sql}')]
+    return [row[0] for row in conn.exec_driver_sql(f'EXPLAIN {sql}')]
+
+
+def plan_problems(dialect, plan, ordered):
+    """Найти в плане последовательное сканирование и лишнюю сортировку"""
+    problems = []
+    for line in plan:
+        if dialect == 'sqlite':
+            # "SCAN track" - полный просмотр, "SCAN ... USING INDEX" - просмотр индекса
+            if line.startswith('SCAN ') and 'USING' not in line:
+                problems.append(line)
+            if ordered and 'USE TEMP B-TREE' in line:
+                problems.append(line)
+        else:
+            if 'Seq Scan' in line:
+                problems.append(line.strip())
+            if ordered and line.strip().startswith(('Sort', '->  Sort')):
+                problems.append(line.strip())
+    return problems
+
+
+@pytest.fixture(scope='module')
+def sqlite_engine():
+    engine = create_engine('sqlite://')
+    seed(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture(scope='module')
+def postgres_engine():
+    url = os.environ.get('TEST_POSTGRES_URL')
+    if not url:
+        pytest.skip('TEST_POSTGRES_URL не задан')
+    engine = create_engine(url)
+    db.metadata.drop_all(engine)
+    seed(engine)
+    yield engine
+    db.metadata.drop_all(engine)
+    engine.dispose()
+
+
+@pytest.mark.parametrize('name,query,ordered', hot_queries(), ids=[q[0] for q in hot_queries()])
+def test_sqlite_query_plan(sqlite_engine, name, query, ordered):
+    with sqlite_engine.connect() as conn:
+        plan = explain(conn, query)
+    assert not plan_problems('sqlite', plan, ordered), f"{name}: {plan}"
+
+
+@pytest.mark.parametrize('name,query,ordered', hot_queries(), ids=[q[0] for q in hot_queries()])
+def test_postgres_query_plan(postgres_engine, name, query, ordered):
+    with postgres_engine.connect() as conn:
+        conn.exec_driver_sql('SET enable_seqscan = off')
+        plan = explain(conn, query)
+    assert not plan_problems('postgresql', plan, ordered), f"{name}: {plan}"